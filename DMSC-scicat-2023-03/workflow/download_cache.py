@@ -0,0 +1,150 @@
+"""Local cache for the files of SciCat datasets.
+
+Files are stored under a key made from the dataset PID, the remote path of
+the file, and the checksum recorded in SciCat.
+So a file is only transferred again if it changed in SciCat.
+The cache can be shared by several environments and notebooks.
+When it grows beyond a size limit, the least recently used files are removed.
+"""
+
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import shutil
+import tempfile
+from typing import Optional, Union
+
+from scitacean import Client, Dataset, File
+
+DEFAULT_CACHE_DIR = Path(
+    os.environ.get("SCICAT_CACHE_DIR", Path.home() / ".cache" / "scicat-workshop")
+)
+DEFAULT_MAX_BYTES = 10 * 1024**3
+
+
+def cache_key(pid: str, file: File) -> Optional[str]:
+    """Return None for files without checksum, those cannot be cached."""
+    checksum = file.checksum()
+    if checksum is None:
+        return None
+    return hashlib.sha256(
+        f"{pid}\n{file.remote_path}\n{checksum}".encode("utf-8")
+    ).hexdigest()
+
+
+def _entry(cache_dir: Path, key: str) -> Path:
+    return cache_dir / key[:2] / key
+
+
+def _cached_file(entry: Path) -> Optional[Path]:
+    """Each entry is a directory that contains one file."""
+    if not entry.is_dir():
+        return None
+    files = [path for path in entry.iterdir() if path.is_file()]
+    return files[0] if len(files) == 1 else None
+
+
+def _download(client: Client, dataset: Dataset, file: File, target: Path) -> Path:
+    downloaded = client.download_files(
+        dataset, target=target, select=lambda f: f.remote_path == file.remote_path
+    )
+    (local_path,) = (
+        f.local_path for f in downloaded.files if f.remote_path == file.remote_path
+    )
+    return Path(local_path)
+
+
+def _download_into_cache(
+    client: Client, dataset: Dataset, file: File, cache_dir: Path, key: str
+) -> Path:
+    entry = _entry(cache_dir, key)
+    entry.parent.mkdir(parents=True, exist_ok=True)
+    # Download into a temporary directory and move it into place at once
+    # such that other processes never see incomplete files.
+    tmp = Path(tempfile.mkdtemp(prefix=".download-", dir=cache_dir))
+    try:
+        local_path = _download(client, dataset, file, tmp / "download")
+        os.replace(local_path, tmp / local_path.name)
+        shutil.rmtree(tmp / "download")
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # Another process was faster.
+            if _cached_file(entry) is None:
+                raise
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return _cached_file(entry)
+
+
+def evict(
+    cache_dir: Union[str, Path] = DEFAULT_CACHE_DIR,
+    max_bytes: int = DEFAULT_MAX_BYTES,
+    keep: tuple[str, ...] = (),
+) -> list[str]:
+    """Remove the least recently used entries until the cache fits in max_bytes.
+
+    Entries in keep are not removed.
+    Returns the keys of removed entries.
+    """
+    entries = []
+    for entry in Path(cache_dir).glob("*/*"):
+        if entry.parent.name.startswith("."):
+            # Download in progress.
+            continue
+        cached = _cached_file(entry)
+        if cached is not None:
+            entries.append((entry.stat().st_mtime, entry, cached.stat().st_size))
+    total = sum(size for *_, size in entries)
+    removed = []
+    for _, entry, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        if entry.name in keep:
+            continue
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+        removed.append(entry.name)
+    return removed
+
+
+def download_files_cached(
+    client: Client,
+    dataset: Dataset,
+    *,
+    target: Union[str, Path] = "./data",
+    cache_dir: Union[str, Path] = DEFAULT_CACHE_DIR,
+    max_bytes: int = DEFAULT_MAX_BYTES,
+    workers: int = 4,
+) -> Dataset:
+    """Like client.download_files but take files from the cache if possible.
+
+    Missing files are downloaded concurrently and added to the cache.
+    Files without a checksum in SciCat are downloaded to target every time.
+    The local paths of the returned dataset point into the cache,
+    do not modify those files.
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    keys = [cache_key(dataset.pid, file) for file in dataset.files]
+
+    def fetch(file_and_key: tuple[File, Optional[str]]) -> File:
+        file, key = file_and_key
+        if key is None:
+            return file.downloaded(
+                local_path=_download(client, dataset, file, Path(target))
+            )
+        entry = _entry(cache_dir, key)
+        local_path = _cached_file(entry)
+        if local_path is None:
+            local_path = _download_into_cache(client, dataset, file, cache_dir, key)
+        else:
+            # Mark as recently used for evict.
+            os.utime(entry)
+        return file.downloaded(local_path=local_path)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        files = list(pool.map(fetch, zip(dataset.files, keys)))
+    evict(cache_dir, max_bytes, keep=tuple(key for key in keys if key is not None))
+    return dataset.replace_files(*files)
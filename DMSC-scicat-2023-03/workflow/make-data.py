@@ -1,14 +1,28 @@
 """Generate input data for exercises."""
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import hashlib
+from itertools import cycle, islice
+import json
+from pathlib import Path
+import random
+import threading
+import time
+from typing import Callable, Optional
+
 import numpy as np
 import plopp as pp
 import scipp as sc
 from dateutil.parser import parse
-from scitacean import Client, Dataset
+from pyscicat.client import ScicatClient
+from scitacean import Client, Dataset, ScicatCommError
 from scitacean.transfer.ssh import SSHFileTransfer
 
 pp.patch_scipp()
 
+SCICAT_URL = "https://staging.scicat.ess.eu/api/v3"
 TOKEN = ""
+UPLOAD_JOURNAL = "data/uploaded.jsonl"
 
 ALL_PEAKS = [
     [(0.41, 0.1, 1.0), (0.65, 0.12, 1.5), (0.89, 0.06, 1.0)],
@@ -57,6 +71,145 @@ def build_data(
     return sc.DataArray(lineshape, coords={"wavelength": x})
 
 
+def _padded(rows: list[list[float]], length: int, fill: float) -> np.ndarray:
+    out = np.full((len(rows), length), fill)
+    for i, row in enumerate(rows):
+        out[i, : len(row)] = row
+    return out
+
+
+def build_data_batch(
+    rng,
+    peak_lists: list[list[tuple[float, float, float]]],
+    bg_slopes: list[float],
+    bg_offsets: list[float],
+    x_ranges: list[tuple[float, float, float]],
+    proton_charges: list[float],
+    chunk_size: int = 256,
+) -> list[sc.DataArray]:
+    """Build many datasets at once.
+
+    Returns the same data as calling build_data for each dataset in turn
+    with the same rng.
+    The gaussians of chunk_size datasets are evaluated in one operation
+    over dims (dataset, peak, wavelength).
+    Datasets with fewer peaks or wavelength bins are padded,
+    the returned data arrays are slices of the padded chunks.
+    """
+    sizes = [int(n) for *_, n in x_ranges]
+    # Draw all noise up front in the order of build_data.
+    noise = np.split(rng.normal(0.0, 0.005, sum(sizes)), np.cumsum(sizes)[:-1])
+
+    out = []
+    for begin in range(0, len(sizes), chunk_size):
+        chunk = slice(begin, begin + chunk_size)
+        n_wavelength = max(sizes[chunk])
+        n_peak = max(len(peak_list) for peak_list in peak_lists[chunk])
+        x = sc.array(
+            dims=["dataset", "wavelength"],
+            values=_padded(
+                [np.linspace(*x_range) for x_range in x_ranges[chunk]],
+                n_wavelength,
+                0.0,
+            ),
+            unit="angstrom",
+        )
+
+        def parameter(i, fill, unit):
+            return sc.array(
+                dims=["dataset", "peak"],
+                values=_padded(
+                    [
+                        [peak[i] for peak in peak_list]
+                        for peak_list in peak_lists[chunk]
+                    ],
+                    n_peak,
+                    fill,
+                ),
+                unit=unit,
+            )
+
+        # Padded peaks have an infinite norm and thus contribute 0.
+        mu = parameter(0, 0.0, "angstrom")
+        sig = parameter(1, 1.0, "angstrom")
+        norm = parameter(2, np.inf, "one")
+
+        offset = sc.array(dims=["dataset"], values=bg_offsets[chunk], unit="counts")
+        slope = sc.array(
+            dims=["dataset"], values=bg_slopes[chunk], unit="counts/angstrom"
+        )
+        background = offset + slope * x
+
+        peaks = (gaussian(x, mu, sig) / norm).sum("peak")
+        peaks.unit = background.unit
+
+        chunk_noise = sc.array(
+            dims=x.dims,
+            values=_padded(noise[chunk], n_wavelength, 0.0),
+            unit=background.unit,
+        )
+
+        charge = sc.array(dims=["dataset"], values=proton_charges[chunk])
+        lineshape = (background + peaks + chunk_noise) * 1000 * charge
+        da = sc.DataArray(lineshape, coords={"wavelength": x})
+        out.extend(
+            da["dataset", i]["wavelength", :size] for i, size in enumerate(sizes[chunk])
+        )
+    return out
+
+
+def write_data(
+    i: int,
+    seed: np.random.SeedSequence,
+    peak_list: list[tuple[float, float, float]],
+    bg_slope: float,
+    bg_offset: float,
+    x_range: tuple[float, float, float],
+    proton_charge: float,
+) -> tuple[str, int]:
+    """Build and write dataset i with its own random stream.
+
+    Returns the file name and the total counts.
+    """
+    rng = np.random.default_rng(seed)
+    da = build_data(rng, peak_list, bg_slope, bg_offset, x_range, proton_charge)
+    label = rng.integers(10000, 100000, 1)[0]
+    # Random labels alone collide for many datasets.
+    filename = f"data/raw_{i}_{label}.h5"
+    da.to_hdf5(filename)
+    return filename, int(da.sum().value)
+
+
+def write_data_parallel(
+    seed: int,
+    peak_lists: list[list[tuple[float, float, float]]],
+    bg_slopes: list[float],
+    bg_offsets: list[float],
+    x_ranges: list[tuple[float, float, float]],
+    proton_charges: list[float],
+    workers: int | None = None,
+) -> list[tuple[str, int]]:
+    """Build and write datasets in a process pool.
+
+    Each dataset gets an independent random stream spawned from seed.
+    So the files and total counts do not depend on the number of workers.
+    """
+    seeds = np.random.SeedSequence(seed).spawn(len(peak_lists))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(
+            pool.map(
+                write_data,
+                range(len(seeds)),
+                seeds,
+                peak_lists,
+                bg_slopes,
+                bg_offsets,
+                x_ranges,
+                proton_charges,
+            )
+        )
+
+
 def build_dataset(
     i: int,
     x_range: tuple[float, float, float],
@@ -95,9 +248,9 @@ def build_dataset(
     return ds
 
 
-def upload_datasets(datasets: list[Dataset]) -> None:
-    client = Client.from_token(
-        url="https://staging.scicat.ess.eu/api/v3",
+def make_client() -> Client:
+    return Client.from_token(
+        url=SCICAT_URL,
         token=TOKEN,
         file_transfer=SSHFileTransfer(
             host="dmsc",
@@ -105,17 +258,191 @@ def upload_datasets(datasets: list[Dataset]) -> None:
         ),
     )
 
+
+def upload_datasets(datasets: list[Dataset]) -> None:
+    client = make_client()
+
     for d in datasets:
         print(f"Uploading {d.name}")
         client.upload_new_dataset_now(d)
 
 
+def upload_key(dataset: Dataset) -> str:
+    """Identify a dataset by its name and the content of its files."""
+    key = hashlib.sha256(dataset.name.encode("utf-8"))
+    for file in sorted(dataset.files, key=lambda f: str(f.remote_path)):
+        key.update(f"\n{file.remote_path}\n{file.checksum()}".encode("utf-8"))
+    return key.hexdigest()
+
+
+def make_find_uploaded() -> Callable[[str], Optional[str]]:
+    """Return a function that looks up the PID of a dataset by upload key.
+
+    scitacean cannot query datasets, this uses the public query of pyscicat.
+    """
+    client = ScicatClient(SCICAT_URL, token=TOKEN)
+
+    def find_uploaded(key: str) -> Optional[str]:
+        found = client.datasets_get_many({"scientificMetadata.upload_key.value": key})
+        return found[0]["pid"] if found else None
+
+    return find_uploaded
+
+
+def load_upload_journal(journal: str) -> dict[str, str]:
+    """Return the PIDs of uploaded datasets by upload key."""
+    try:
+        lines = Path(journal).read_text().splitlines()
+    except FileNotFoundError:
+        return {}
+    uploaded = {}
+    for line in lines:
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError:
+            # The last line is incomplete if writing it was interrupted.
+            continue
+        if "key" in entry:
+            uploaded[entry["key"]] = entry["pid"]
+    return uploaded
+
+
+def upload_datasets_concurrently(
+    datasets: list[Dataset],
+    client_factory: Callable[[], Client] = make_client,
+    find_uploaded: Optional[Callable[[str], Optional[str]]] = None,
+    workers: int = 4,
+    retries: int = 4,
+    backoff: float = 1.0,
+    journal: str = UPLOAD_JOURNAL,
+) -> dict[str, str]:
+    """Upload datasets in a thread pool.
+
+    Each thread makes one client with client_factory and reuses it for all of
+    its uploads.
+    Every dataset gets an upload key made from its name and file checksums,
+    see upload_key, which is stored in its scientific metadata.
+    The key and PID of every finished upload are appended to the journal.
+    Datasets in the journal are skipped, so an interrupted batch can be
+    resumed by calling this function again.
+    Datasets with the same name but other files are uploaded again.
+
+    Failed uploads are retried with exponential backoff.
+    An upload can fail after SciCat has stored the dataset, e.g. on a timeout.
+    So before every attempt, find_uploaded looks up the key in SciCat and
+    the dataset is only uploaded if it is not found.
+    Defaults to make_find_uploaded().
+
+    Returns the PIDs of all datasets by name.
+    """
+    if find_uploaded is None:
+        find_uploaded = make_find_uploaded()
+    uploaded = load_upload_journal(journal)
+    local = threading.local()
+    journal_lock = threading.Lock()
+
+    def upload(d: Dataset, key: str) -> str:
+        if not hasattr(local, "client"):
+            local.client = client_factory()
+        for attempt in range(retries + 1):
+            try:
+                pid = find_uploaded(key)
+                if pid is None:
+                    pid = str(local.client.upload_new_dataset_now(d).pid)
+                else:
+                    print(f"{d.name} was already uploaded")
+                break
+            except (ScicatCommError, OSError) as err:
+                if attempt == retries:
+                    raise
+                delay = backoff * 2**attempt * random.uniform(0.5, 1.5)
+                print(f"Upload of {d.name} failed ({err}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+        with journal_lock, open(journal, "a") as f:
+            f.write(json.dumps({"key": key, "name": d.name, "pid": pid}) + "\n")
+        print(f"Uploaded {d.name} as {pid}")
+        return pid
+
+    pids = {}
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for d in datasets:
+            key = upload_key(d)
+            if key in uploaded:
+                pids[d.name] = uploaded[key]
+                continue
+            d.meta["upload_key"] = {"value": key, "unit": ""}
+            futures[pool.submit(upload, d, key)] = d.name
+        for future in as_completed(futures):
+            try:
+                pids[futures[future]] = future.result()
+            except Exception as err:
+                print(f"Upload of {futures[future]} failed: {err}")
+                failed.append(futures[future])
+    if failed:
+        raise RuntimeError(f"Failed to upload {len(failed)} datasets: {failed}")
+    return pids
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Generate input data for exercises")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Write the data in this many processes."
+        " Uses independent random streams per dataset and thus differs"
+        " from the default serial output.",
+    )
+    parser.add_argument(
+        "--num-datasets",
+        type=int,
+        default=len(ALL_PEAKS),
+        help="Number of datasets to make with --workers,"
+        " cycles through the built-in parameters",
+    )
+    return parser.parse_args()
+
+
+def main_parallel(workers: int, num_datasets: int) -> None:
+    params = [
+        list(islice(cycle(p), num_datasets))
+        for p in (ALL_PEAKS, BG_SLOPES, BG_OFFSETS, X_RANGES, PROTON_CHARGES)
+    ]
+    written = write_data_parallel(74712, *params, workers=workers)
+    dsets = [
+        build_dataset(str(i), x_range, proton_charge, filename, total_counts)
+        for i, ((filename, total_counts), x_range, proton_charge) in enumerate(
+            zip(written, params[3], params[4])
+        )
+    ]
+    for ds in dsets:
+        print(ds)
+        print(list(ds.files))
+    # upload_datasets_concurrently(dsets)
+
+    # Input for reduction.py
+    manifest = [
+        {"input": filename, "proton_charge": ds.meta["proton_charge"]}
+        for (filename, _), ds in zip(written, dsets)
+    ]
+    Path("data/manifest.json").write_text(json.dumps(manifest, indent=1))
+
+
 def main() -> None:
+    args = parse_args()
+    if args.workers is not None:
+        main_parallel(args.workers, args.num_datasets)
+        return
+
     rng = np.random.default_rng(74712)
     data = {
-        str(i): build_data(rng, *args)
-        for i, args in enumerate(
-            zip(ALL_PEAKS, BG_SLOPES, BG_OFFSETS, X_RANGES, PROTON_CHARGES)
+        str(i): da
+        for i, da in enumerate(
+            build_data_batch(
+                rng, ALL_PEAKS, BG_SLOPES, BG_OFFSETS, X_RANGES, PROTON_CHARGES
+            )
         )
     }
     filenames = {}
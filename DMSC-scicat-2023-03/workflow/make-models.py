@@ -1,46 +1,195 @@
 """Create auxiliary models in SciCat."""
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from importlib.metadata import version
+import json
+import sys
+from typing import Any
+from urllib.parse import quote
+import warnings
+
 from pyscicat import model
 from pyscicat.client import ScicatClient
 
+# _query relies on internals of this version.
+# It is pinned in scicat-workshop.yml and requirements.in.
+PYSCICAT_VERSION = "0.2.6"
+if version("pyscicat") != PYSCICAT_VERSION:
+    warnings.warn(
+        f"make-models.py was written for pyscicat {PYSCICAT_VERSION} "
+        f"but {version('pyscicat')} is installed, looking up models may fail"
+    )
+
+# Number of keys per query when looking up existing models.
+LOOKUP_BATCH_SIZE = 100
+
+# Model class, endpoint, field that identifies an object, create method.
+MODEL_KINDS = {
+    "instruments": (model.Instrument, "Instruments", "name", "instruments_create"),
+    "proposals": (model.Proposal, "Proposals", "proposalId", "proposals_create"),
+    "samples": (model.Sample, "Samples", "description", "samples_create"),
+}
+
+WORKSHOP_MODELS = {
+    "instruments": [{"name": "PeakMeister", "customMetadata": {"Real": False}}],
+    "proposals": [
+        {
+            "proposalId": "276577",
+            "pi_email": "Max.Novelli@ess.eu",
+            "pi_firstname": "Massimiliano",
+            "pi_lastname": "Novelli",
+            "email": "Max.Novelli@ess.eu",
+            "firstname": "Massimiliano",
+            "lastname": "Novelli",
+            "title": "DMSC SciCat Workshop 2023",
+            "abstract": "Workshop on SciCat for DMSC in spring 2023",
+            "startTime": "2023-03-22T00:00:00Z",
+            "ownerGroup": "ess",
+            "accessGroups": ["dmsc"],
+        }
+    ],
+    "samples": [
+        {
+            "owner": "Massimiliano Novelli",
+            "description": "Dummy sample for the SciCat Workshop at DMSC in spring 2023",
+            "ownerGroup": "ess",
+            "accessGroups": ["dmsc"],
+        }
+    ],
+}
+
+
+def _query(
+    client: ScicatClient, kind: str, query: dict[str, Any]
+) -> list[dict[str, Any]]:
+    """Return the models of the given kind that match a loopback filter.
+
+    pyscicat has no query functions for instruments, proposals, and samples.
+    This is the only place that uses its private ScicatClient._call_endpoint.
+    Check it when updating pyscicat beyond PYSCICAT_VERSION.
+    """
+    _, endpoint, _, _ = MODEL_KINDS[kind]
+    result = client._call_endpoint(
+        cmd="get",
+        endpoint=f"{endpoint}?filter={quote(json.dumps(query))}",
+        operation=f"{kind}_find",
+    )
+    return result or []
+
+
+def find_existing(
+    client: ScicatClient, kind: str, keys: list[str]
+) -> dict[str, dict[str, Any]]:
+    """Look up models of the given kind by their identifying field.
+
+    Returns the models that exist in SciCat by key.
+    """
+    key_field = MODEL_KINDS[kind][2]
+    found = {}
+    for begin in range(0, len(keys), LOOKUP_BATCH_SIZE):
+        query = {"where": {key_field: {"inq": keys[begin : begin + LOOKUP_BATCH_SIZE]}}}
+        for obj in _query(client, kind, query):
+            found[obj[key_field]] = obj
+    return found
+
+
+def provision(
+    client: ScicatClient, models: dict[str, list[dict[str, Any]]], workers: int = 8
+) -> dict[str, dict[str, list[str]]]:
+    """Create all models that do not exist yet.
+
+    models maps kinds from MODEL_KINDS to lists of model fields.
+    Existing models are fetched first and only missing ones are created,
+    so this can be rerun safely.
+    A failed create does not stop the others, every failure is printed.
+    Returns the keys of created, already existing, and failed models by kind.
+    """
+    cache = {
+        kind: find_existing(
+            client, kind, [fields[MODEL_KINDS[kind][2]] for fields in entries]
+        )
+        for kind, entries in models.items()
+    }
+
+    report = {kind: {"created": [], "existing": [], "failed": []} for kind in models}
+    missing = []
+    for kind, entries in models.items():
+        model_class, _, key_field, create = MODEL_KINDS[kind]
+        for fields in entries:
+            key = fields[key_field]
+            if key in cache[kind]:
+                report[kind]["existing"].append(key)
+            else:
+                # Later entries with the same key count as existing.
+                cache[kind][key] = fields
+                missing.append(
+                    (kind, key, getattr(client, create), model_class(**fields))
+                )
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(create, obj): (kind, key) for kind, key, create, obj in missing
+        }
+        for future in as_completed(futures):
+            kind, key = futures[future]
+            try:
+                print(f"{kind[:-1]} {key}:", future.result())
+            except Exception as err:
+                print(f"Failed to create {kind[:-1]} {key}: {err}")
+                report[kind]["failed"].append(key)
+            else:
+                report[kind]["created"].append(key)
+    return report
+
+
+def _provision_workshop_model(client: ScicatClient, kind: str) -> None:
+    report = provision(client, {kind: WORKSHOP_MODELS[kind]})
+    if report[kind]["failed"]:
+        raise RuntimeError(f"Failed to create {kind}: {report[kind]['failed']}")
+
 
 def make_instrument(client: ScicatClient) -> None:
-    instrument = model.Instrument(name="PeakMeister", customMetadata={"Real": False})
-    print("instrument:", client.instruments_create(instrument))
+    _provision_workshop_model(client, "instruments")
 
 
 def make_proposal(client: ScicatClient) -> None:
-    proposal = model.Proposal(
-        proposalId="276577",
-        pi_email="Max.Novelli@ess.eu",
-        pi_firstname="Massimiliano",
-        pi_lastname="Novelli",
-        email="Max.Novelli@ess.eu",
-        firstname="Massimiliano",
-        lastname="Novelli",
-        title="DMSC SciCat Workshop 2023",
-        abstract="Workshop on SciCat for DMSC in spring 2023",
-        startTime="2023-03-22T00:00:00Z",
-        ownerGroup="ess",
-        accessGroups=["dmsc"],
-    )
-    print("proposal:", client.proposals_create(proposal))
+    _provision_workshop_model(client, "proposals")
 
 
 def make_sample(client: ScicatClient) -> None:
-    sample = model.Sample(
-        owner="Massimiliano Novelli",
-        description="Dummy sample for the SciCat Workshop at DMSC in spring 2023",
-        ownerGroup="ess",
-        accessGroups=["dmsc"],
+    _provision_workshop_model(client, "samples")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Create auxiliary models in SciCat")
+    parser.add_argument(
+        "--models",
+        help="JSON file with lists of model fields under 'instruments',"
+        " 'proposals', and 'samples'. Defaults to the models for the workshop.",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=8, help="Number of concurrent create calls"
     )
-    print("sample:", client.samples_create(sample))
+    return parser.parse_args()
 
 
 def main() -> None:
+    args = parse_args()
+    if args.models is None:
+        models = WORKSHOP_MODELS
+    else:
+        with open(args.models) as f:
+            models = json.load(f)
     client = ScicatClient("https://staging.scicat.ess.eu/api/v3", token="")
-    make_instrument(client)
-    make_proposal(client)
-    make_sample(client)
+    report = provision(client, models, workers=args.workers)
+    for kind, keys in report.items():
+        print(
+            f"{kind}: created {len(keys['created'])}, "
+            f"already existed {len(keys['existing'])}, "
+            f"failed {len(keys['failed'])}"
+        )
+    if any(keys["failed"] for keys in report.values()):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,343 @@
+"""Fit gaussian peaks on a linear background to many spectra at once.
+
+The model is the one used by make-data.py:
+    offset + slope * x + sum_k amplitude_k * exp(-((x - mu_k) / sigma_k)**2)
+A peak of build_data with (mu, sig, norm) has
+    amplitude = 1000 * proton_charge / (2 * sqrt(2 pi) * norm).
+
+All spectra are fitted together with Levenberg-Marquardt, i.e.,
+the model, the Jacobian, and the normal equations are computed for the whole
+batch with array operations and every spectrum has its own damping.
+
+Run this file to recover the peaks of make-data.py and measure the speed:
+    python peak_fit.py --size 10000
+"""
+
+import argparse
+from dataclasses import dataclass
+import importlib.util
+from pathlib import Path
+import time
+from typing import Optional, Sequence
+
+import numpy as np
+import scipp as sc
+
+# Number of spectra whose Jacobians are held in memory at once.
+CHUNK_SIZE = 1024
+# Initial damping relative to the diagonal of the curvature matrix.
+# Large values make the first steps small which avoids jumping to peaks that
+# are so wide that they mimic the background.
+INITIAL_DAMPING = 100.0
+# Number of background parameters, each peak has 3 more (mu, sigma, amplitude).
+N_BACKGROUND = 2
+
+
+@dataclass
+class PeakFit:
+    # mu, sigma, and amplitude with dims (spectrum, peak)
+    peaks: sc.Dataset
+    # offset and slope with dim spectrum
+    background: sc.Dataset
+    # chi^2 per degree of freedom
+    reduced_chi2: sc.Variable
+    converged: sc.Variable
+
+
+def _model(x: np.ndarray, p: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Evaluate the model for all spectra.
+
+    Returns the model and the scaled distances and gaussians of all peaks
+    with shape (spectrum, peak, wavelength) for the Jacobian.
+    """
+    mu = p[:, N_BACKGROUND::3, np.newaxis]
+    sigma = p[:, N_BACKGROUND + 1 :: 3, np.newaxis]
+    amplitude = p[:, N_BACKGROUND + 2 :: 3, np.newaxis]
+    z = (x[:, np.newaxis, :] - mu) / sigma
+    g = np.exp(-(z**2))
+    y = p[:, :1] + p[:, 1:2] * x + np.einsum("nkw,nkw->nw", amplitude, g)
+    return y, z, g
+
+
+def _jacobian(x: np.ndarray, p: np.ndarray, z: np.ndarray, g: np.ndarray) -> np.ndarray:
+    """Derivatives of the model with shape (spectrum, parameter, wavelength)."""
+    n, w = x.shape
+    sigma = p[:, N_BACKGROUND + 1 :: 3, np.newaxis]
+    amplitude = p[:, N_BACKGROUND + 2 :: 3, np.newaxis]
+    jac = np.empty((n, p.shape[1], w))
+    jac[:, 0] = 1.0
+    jac[:, 1] = x
+    d_mu = 2 * amplitude * g * z / sigma
+    jac[:, N_BACKGROUND::3] = d_mu
+    jac[:, N_BACKGROUND + 1 :: 3] = d_mu * z
+    jac[:, N_BACKGROUND + 2 :: 3] = g
+    return jac
+
+
+def _normal_equations(
+    jac: np.ndarray, weights: np.ndarray, residual: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    weighted = jac * weights[:, np.newaxis, :]
+    return (
+        np.matmul(weighted, jac.transpose(0, 2, 1)),
+        np.matmul(weighted, residual[:, :, np.newaxis])[:, :, 0],
+    )
+
+
+def _cost(y: np.ndarray, weights: np.ndarray, model: np.ndarray) -> np.ndarray:
+    return np.sum(weights * (y - model) ** 2, axis=1)
+
+
+def _initial_parameters(
+    x: np.ndarray, y: np.ndarray, weights: np.ndarray, peaks: np.ndarray
+) -> np.ndarray:
+    """Solve for background and amplitudes with fixed peak positions and widths.
+
+    The model is linear in those.
+    """
+    n, n_peaks, _ = peaks.shape
+    p = np.zeros((n, N_BACKGROUND + 3 * n_peaks))
+    p[:, N_BACKGROUND::3] = peaks[:, :, 0]
+    p[:, N_BACKGROUND + 1 :: 3] = peaks[:, :, 1]
+    _, _, g = _model(x, p)
+    basis = np.concatenate(
+        [np.ones_like(x)[:, np.newaxis], x[:, np.newaxis], g], axis=1
+    )
+    a, b = _normal_equations(basis, weights, y)
+    a += (
+        1e-12
+        * np.trace(a, axis1=1, axis2=2)[:, np.newaxis, np.newaxis]
+        * np.eye(a.shape[1])
+    )
+    coefficients = np.linalg.solve(a, b[:, :, np.newaxis])[:, :, 0]
+    p[:, :N_BACKGROUND] = coefficients[:, :N_BACKGROUND]
+    p[:, N_BACKGROUND + 2 :: 3] = coefficients[:, N_BACKGROUND:]
+    return p
+
+
+def _levenberg_marquardt(
+    x: np.ndarray,
+    y: np.ndarray,
+    weights: np.ndarray,
+    p: np.ndarray,
+    max_iterations: int,
+    tolerance: float,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Returns parameters, cost, curvature matrices, and convergence flags."""
+    n, n_parameters = p.shape
+    damping = np.full(n, INITIAL_DAMPING)
+    model, z, g = _model(x, p)
+    cost = _cost(y, weights, model)
+    converged = np.zeros(n, dtype=bool)
+    x_min = x.min(axis=1, keepdims=True)
+    x_max = x.max(axis=1, keepdims=True)
+    # Spectra that are still being fitted.
+    active = np.arange(n)
+    for _ in range(max_iterations):
+        xa, ya, wa, pa = x[active], y[active], weights[active], p[active]
+        jac = _jacobian(xa, pa, z, g)
+        curvature, gradient = _normal_equations(jac, wa, ya - model)
+        diagonal = np.diagonal(curvature, axis1=1, axis2=2)
+        # Keep the damped matrix positive definite if a parameter has no effect.
+        diagonal = np.maximum(diagonal, 1e-12 * diagonal.max(axis=1, keepdims=True))
+        damped = curvature + damping[active, np.newaxis, np.newaxis] * (
+            diagonal[:, :, np.newaxis] * np.eye(n_parameters)
+        )
+        step = np.linalg.solve(damped, gradient[:, :, np.newaxis])[:, :, 0]
+        trial = pa + step
+        trial_model, trial_z, trial_g = _model(xa, trial)
+        trial_cost = _cost(ya, wa, trial_model)
+
+        # Steps that move peaks out of the data are rejected like steps that
+        # increase the cost.
+        trial_mu = trial[:, N_BACKGROUND::3]
+        inside = np.all(
+            (trial_mu >= x_min[active]) & (trial_mu <= x_max[active]), axis=1
+        )
+        better = inside & np.isfinite(trial_cost) & (trial_cost < cost[active])
+        improvement = cost[active] - trial_cost
+        p[active[better]] = trial[better]
+        damping[active[better]] /= 10
+        damping[active[~better]] *= 10
+        done = (better & (improvement <= tolerance * cost[active])) | (
+            damping[active] > 1e10
+        )
+        converged[active[done]] = damping[active[done]] <= 1e10
+        cost[active[better]] = trial_cost[better]
+
+        model = np.where(better[:, np.newaxis], trial_model, model)
+        z = np.where(better[:, np.newaxis, np.newaxis], trial_z, z)
+        g = np.where(better[:, np.newaxis, np.newaxis], trial_g, g)
+        keep = ~done
+        active, model, z, g = active[keep], model[keep], z[keep], g[keep]
+        if len(active) == 0:
+            break
+
+    # The model does not depend on the sign of sigma.
+    p[:, N_BACKGROUND + 1 :: 3] = np.abs(p[:, N_BACKGROUND + 1 :: 3])
+    _, z, g = _model(x, p)
+    curvature, _ = _normal_equations(_jacobian(x, p, z, g), weights, y)
+    return p, cost, curvature, converged
+
+
+def _stack(
+    spectra: Sequence[sc.DataArray],
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, bool]:
+    """Pad spectra to a common length, padding has weight 0."""
+    length = max(da.sizes["wavelength"] for da in spectra)
+    x = np.zeros((len(spectra), length))
+    y = np.zeros((len(spectra), length))
+    weights = np.zeros((len(spectra), length))
+    has_variances = all(da.variances is not None for da in spectra)
+    for i, da in enumerate(spectra):
+        n = da.sizes["wavelength"]
+        x[i, :n] = da.coords["wavelength"].values
+        x[i, n:] = x[i, n - 1] if n else 0.0
+        y[i, :n] = da.values
+        weights[i, :n] = 1 / da.variances if has_variances else 1.0
+    finite = np.isfinite(y) & np.isfinite(weights)
+    weights[~finite] = 0.0
+    y[~finite] = 0.0
+    return x, y, weights, has_variances
+
+
+def fit_peaks(
+    spectra: Sequence[sc.DataArray],
+    peaks: np.ndarray,
+    max_iterations: int = 100,
+    tolerance: float = 1e-10,
+    chunk_size: Optional[int] = None,
+) -> PeakFit:
+    """Fit len(peaks) gaussians plus a linear background to every spectrum.
+
+    The spectra must have a 'wavelength' coord and can differ in length.
+    peaks holds initial (mu, sigma) in the unit of the wavelength coord,
+    either with shape (peak, 2) for all spectra or (spectrum, peak, 2).
+    Amplitudes and background are initialized with a linear fit.
+
+    Uncertainties are the square roots of the diagonal of the covariance matrix.
+    If the spectra have no variances, the covariance is scaled by
+    the reduced chi^2.
+    """
+    chunk_size = CHUNK_SIZE if chunk_size is None else chunk_size
+    peaks = np.broadcast_to(
+        np.asarray(peaks, dtype=float), (len(spectra), *np.shape(peaks)[-2:])
+    )
+    n_parameters = N_BACKGROUND + 3 * peaks.shape[1]
+    p = np.empty((len(spectra), n_parameters))
+    variances = np.empty_like(p)
+    reduced_chi2 = np.empty(len(spectra))
+    converged = np.empty(len(spectra), dtype=bool)
+    for begin in range(0, len(spectra), chunk_size):
+        chunk = slice(begin, begin + chunk_size)
+        x, y, weights, has_variances = _stack(spectra[chunk])
+        initial = _initial_parameters(x, y, weights, peaks[chunk])
+        p[chunk], cost, curvature, converged[chunk] = _levenberg_marquardt(
+            x, y, weights, initial, max_iterations, tolerance
+        )
+        dof = np.maximum(np.count_nonzero(weights, axis=1) - n_parameters, 1)
+        reduced_chi2[chunk] = cost / dof
+        covariance = np.linalg.pinv(curvature)
+        if not has_variances:
+            covariance *= reduced_chi2[chunk, np.newaxis, np.newaxis]
+        variances[chunk] = np.diagonal(covariance, axis1=1, axis2=2)
+
+    x_unit = spectra[0].coords["wavelength"].unit
+    y_unit = spectra[0].unit
+
+    def table(index, dims, unit):
+        return sc.array(
+            dims=dims,
+            values=p[:, index],
+            variances=variances[:, index],
+            unit=unit,
+        )
+
+    return PeakFit(
+        peaks=sc.Dataset(
+            {
+                "mu": table(slice(N_BACKGROUND, None, 3), ["spectrum", "peak"], x_unit),
+                "sigma": table(
+                    slice(N_BACKGROUND + 1, None, 3), ["spectrum", "peak"], x_unit
+                ),
+                "amplitude": table(
+                    slice(N_BACKGROUND + 2, None, 3), ["spectrum", "peak"], y_unit
+                ),
+            }
+        ),
+        background=sc.Dataset(
+            {
+                "offset": table(0, ["spectrum"], y_unit),
+                "slope": table(1, ["spectrum"], y_unit / x_unit),
+            }
+        ),
+        reduced_chi2=sc.array(dims=["spectrum"], values=reduced_chi2),
+        converged=sc.array(dims=["spectrum"], values=converged),
+    )
+
+
+def _load_make_data():
+    spec = importlib.util.spec_from_file_location(
+        "make_data", Path(__file__).with_name("make-data.py")
+    )
+    make_data = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(make_data)
+    return make_data
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Recover the peaks of make-data.py with fit_peaks"
+    )
+    parser.add_argument("--size", type=int, default=10_000, help="Number of spectra")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    make_data = _load_make_data()
+    rng = np.random.default_rng(8913)
+    params = [
+        [p[i % len(p)] for i in range(args.size)]
+        for p in (
+            make_data.ALL_PEAKS,
+            make_data.BG_SLOPES,
+            make_data.BG_OFFSETS,
+            make_data.X_RANGES,
+            make_data.PROTON_CHARGES,
+        )
+    ]
+    spectra = make_data.build_data_batch(rng, *params)
+    true_peaks = np.array(params[0])
+    # Start up to 0.02 angstrom and 10% away from the true positions and widths.
+    initial = true_peaks[:, :, :2].copy()
+    initial[:, :, 0] += rng.uniform(-0.02, 0.02, initial.shape[:2])
+    initial[:, :, 1] *= rng.uniform(0.9, 1.1, initial.shape[:2])
+
+    start = time.perf_counter()
+    fit = fit_peaks(spectra, initial)
+    duration = time.perf_counter() - start
+
+    charge = np.array(params[4])[:, np.newaxis]
+    norm = 1000 * charge / (2 * np.sqrt(2 * np.pi) * fit.peaks["amplitude"].values)
+    recovered = np.stack(
+        [fit.peaks["mu"].values, fit.peaks["sigma"].values, norm], axis=-1
+    )
+    error = np.abs(recovered - true_peaks).max(axis=(0, 1))
+    # Deviation in units of the estimated uncertainty.
+    pull = (fit.peaks["mu"].values - true_peaks[:, :, 0]) / np.sqrt(
+        fit.peaks["mu"].variances
+    )
+    print(
+        f"Fitted {args.size} spectra in {duration:.2f}s,"
+        f" {np.count_nonzero(fit.converged.values)} converged"
+    )
+    print(
+        "Largest deviation from ALL_PEAKS:"
+        f" mu {error[0]:.2g}, sigma {error[1]:.2g}, norm {error[2]:.2g}"
+    )
+    print(f"Standard deviation of (mu - true mu) / uncertainty: {np.std(pull):.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""Reduce raw wavelength spectra like in the exercise, for many files at once.
+
+Run
+    python reduction.py data/manifest.json --output-dir data/reduced
+to reduce all files in a manifest as written by `make-data.py --workers`.
+The manifest is a JSON list of objects with keys
+'input' (the file name) and 'proton_charge' ({"value": ..., "unit": ...}).
+
+For every input, this writes the corrected data and a provenance record.
+The 'meta' of the record can be added to a derived dataset, e.g.,
+    derived.meta.update(record["meta"])
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+from pathlib import Path
+from typing import Any, Union
+
+import scipp as sc
+
+BACKGROUND_RANGE = (1.3 * sc.Unit("Å"), 1.4 * sc.Unit("Å"))
+
+
+def reduce_data(
+    raw_data: sc.DataArray,
+    proton_charge: sc.Variable,
+    background_range: tuple[sc.Variable, sc.Variable] = BACKGROUND_RANGE,
+) -> tuple[sc.DataArray, sc.Variable]:
+    """Subtract the mean in background_range and normalize by the proton charge.
+
+    Returns the corrected data and the background.
+    """
+    background = raw_data["wavelength", slice(*background_range)].mean()
+    return (raw_data - background) / proton_charge, background.data
+
+
+def reduce_file(
+    input_file: Union[str, Path],
+    output_file: Union[str, Path],
+    proton_charge: dict[str, Any],
+    background_range: tuple[sc.Variable, sc.Variable] = BACKGROUND_RANGE,
+) -> dict[str, Any]:
+    """Reduce one file and return its provenance record.
+
+    proton_charge is given like in the dataset metadata:
+    {"value": ..., "unit": ...}.
+    """
+    raw_data = sc.io.load_hdf5(input_file)
+    corrected, background = reduce_data(
+        raw_data,
+        sc.scalar(proton_charge["value"], unit=proton_charge["unit"]),
+        background_range,
+    )
+    corrected.save_hdf5(output_file)
+    start, stop = background_range
+    return {
+        "input": str(input_file),
+        "output": str(output_file),
+        "used_software": [f"scipp=={sc.__version__}"],
+        "meta": {
+            "background_method": {"value": "average", "unit": ""},
+            "background_range_min": {
+                "value": str(start.value),
+                "unit": str(start.unit),
+            },
+            "background_range_max": {"value": str(stop.value), "unit": str(stop.unit)},
+            "background": {
+                "value": str(background.value),
+                "unit": str(background.unit),
+            },
+            "proton_charge": proton_charge,
+        },
+    }
+
+
+def _reduce_entry(entry: dict[str, Any], output_dir: Path) -> str:
+    """Reduce one manifest entry and write its provenance record next to the output.
+
+    Only returns the name of the record to keep the results of the pool small.
+    """
+    input_file = Path(entry["input"])
+    output_file = output_dir / f"corrected_{input_file.stem}.h5"
+    record = reduce_file(input_file, output_file, entry["proton_charge"])
+    record_file = output_dir / f"corrected_{input_file.stem}.provenance.json"
+    record_file.write_text(json.dumps(record, indent=1))
+    return str(record_file)
+
+
+def reduce_manifest(
+    manifest: list[dict[str, Any]],
+    output_dir: Union[str, Path],
+    workers: int | None = None,
+) -> list[str]:
+    """Reduce all files in manifest in a process pool.
+
+    Uses one process per core unless workers is given.
+    Each worker holds only one file at a time.
+    Returns the file names of the provenance records in the order of manifest.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(
+            pool.map(
+                _reduce_entry,
+                manifest,
+                [output_dir] * len(manifest),
+                chunksize=max(1, len(manifest) // (4 * workers)),
+            )
+        )
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Reduce many raw spectra")
+    parser.add_argument("manifest", help="JSON file with inputs and proton charges")
+    parser.add_argument("--output-dir", default="data/reduced")
+    parser.add_argument("--workers", type=int, default=None)
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    with open(args.manifest) as f:
+        manifest = json.load(f)
+    records = reduce_manifest(manifest, args.output_dir, workers=args.workers)
+    print(f"Reduced {len(records)} files into {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
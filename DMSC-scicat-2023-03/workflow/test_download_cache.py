@@ -0,0 +1,152 @@
+"""Tests for the download cache in download_cache.py.
+
+They use the in-memory SciCat client and file transfer of scitacean.testing.
+Run with `python -m pytest` from the workflow folder.
+"""
+import os
+from pathlib import Path
+import threading
+
+import pytest
+from scitacean import Dataset, File
+from scitacean.testing.client import FakeClient
+from scitacean.testing.transfer import FakeFileTransfer
+
+import download_cache
+
+FILES = {"spectrum.h5": b"spectrum data", "notes.txt": b"some notes"}
+
+
+@pytest.fixture
+def client():
+    return FakeClient(file_transfer=FakeFileTransfer(source_folder="/upload/{pid.pid}"))
+
+
+@pytest.fixture
+def dataset(client, tmp_path):
+    upload_dir = tmp_path / "upload"
+    upload_dir.mkdir()
+    for name, content in FILES.items():
+        (upload_dir / name).write_bytes(content)
+    ds = Dataset(
+        type="raw",
+        name="Cached dataset",
+        owner="Jan-Lukas Wynen",
+        owner_email="jan-lukas.wynen@ess.eu",
+        principal_investigator="Jan-Lukas Wynen",
+        contact_email="jan-lukas.wynen@ess.eu",
+        owner_group="ess",
+        access_groups=["dmsc"],
+        creation_location="ess/dmsc/PeakMeister",
+        checksum_algorithm="md5",
+    )
+    ds.add_local_files(*(upload_dir / name for name in FILES), base_path=upload_dir)
+    return client.get_dataset(client.upload_new_dataset_now(ds).pid)
+
+
+@pytest.fixture
+def downloads(client, monkeypatch):
+    """Record the remote paths of all files that are downloaded."""
+    calls = []
+    download_files = client.download_files
+
+    def counting(dataset, *, target, select):
+        downloaded = download_files(dataset, target=target, select=select)
+        calls.extend(str(f.remote_path) for f in dataset.files if select(f))
+        return downloaded
+
+    monkeypatch.setattr(client, "download_files", counting)
+    return calls
+
+
+def fetch(client, dataset, tmp_path, **kwargs) -> dict[str, bytes]:
+    """Return the contents of the fetched files by name."""
+    downloaded = download_cache.download_files_cached(
+        client,
+        dataset,
+        target=tmp_path / "target",
+        cache_dir=tmp_path / "cache",
+        **kwargs,
+    )
+    return {
+        Path(f.local_path).name: Path(f.local_path).read_bytes()
+        for f in downloaded.files
+    }
+
+
+def test_first_fetch_downloads_all_files(client, dataset, downloads, tmp_path):
+    assert fetch(client, dataset, tmp_path) == FILES
+    assert sorted(downloads) == sorted(FILES)
+
+
+def test_cache_hit_does_not_download_again(client, dataset, downloads, tmp_path):
+    fetch(client, dataset, tmp_path)
+    assert fetch(client, dataset, tmp_path) == FILES
+    assert len(downloads) == len(FILES)
+
+
+def test_changed_checksum_downloads_again(
+    client, dataset, downloads, tmp_path, monkeypatch
+):
+    fetch(client, dataset, tmp_path)
+    # As if the files were replaced in SciCat.
+    monkeypatch.setattr(File, "checksum", lambda self: "changed")
+    assert fetch(client, dataset, tmp_path) == FILES
+    assert len(downloads) == 2 * len(FILES)
+
+
+def test_concurrent_fetches_of_the_same_files(client, dataset, tmp_path):
+    n = 4
+    barrier = threading.Barrier(n)
+    results = [None] * n
+
+    def run(i):
+        barrier.wait()
+        results[i] = fetch(client, dataset, tmp_path)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [FILES] * n
+    # One entry per file and no leftover temporary downloads.
+    assert len(list((tmp_path / "cache").glob("*/*"))) == len(FILES)
+    assert not list((tmp_path / "cache").glob(".download-*"))
+
+
+def make_entry(cache_dir: Path, key: str, size: int, mtime: float) -> None:
+    entry = cache_dir / key[:2] / key
+    entry.mkdir(parents=True)
+    (entry / "file.dat").write_bytes(b"x" * size)
+    os.utime(entry, (mtime, mtime))
+
+
+def test_evict_removes_least_recently_used_entries_beyond_size_limit(tmp_path):
+    for i, key in enumerate(("aa1", "bb2", "cc3", "dd4")):
+        make_entry(tmp_path, key, 100, mtime=1000 + i)
+    removed = download_cache.evict(tmp_path, max_bytes=250)
+    assert removed == ["aa1", "bb2"]
+    assert sorted(p.name for p in tmp_path.glob("*/*")) == ["cc3", "dd4"]
+
+
+def test_evict_keeps_entries_in_use(tmp_path):
+    for i, key in enumerate(("aa1", "bb2", "cc3")):
+        make_entry(tmp_path, key, 100, mtime=1000 + i)
+    removed = download_cache.evict(tmp_path, max_bytes=200, keep=("aa1",))
+    assert removed == ["bb2"]
+    assert sorted(p.name for p in tmp_path.glob("*/*")) == ["aa1", "cc3"]
+
+
+def test_evict_does_nothing_within_size_limit(tmp_path):
+    for i, key in enumerate(("aa1", "bb2")):
+        make_entry(tmp_path, key, 100, mtime=1000 + i)
+    assert download_cache.evict(tmp_path, max_bytes=200) == []
+
+
+def test_fetch_evicts_old_entries_but_not_its_own_files(client, dataset, tmp_path):
+    cache_dir = tmp_path / "cache"
+    make_entry(cache_dir, "ff0", 1000, mtime=1000)
+    assert fetch(client, dataset, tmp_path, max_bytes=100) == FILES
+    assert not (cache_dir / "ff" / "ff0").exists()
+    assert len(list(cache_dir.glob("*/*"))) == len(FILES)
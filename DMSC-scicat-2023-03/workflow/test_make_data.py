@@ -0,0 +1,143 @@
+"""Tests for the concurrent upload in make-data.py.
+
+They use the in-memory SciCat client and file transfer of scitacean.testing.
+Run with `python -m pytest` from the workflow folder.
+"""
+import importlib.util
+import json
+from pathlib import Path
+
+import pytest
+from scitacean import ScicatCommError
+from scitacean.testing.client import FakeClient
+from scitacean.testing.transfer import FakeFileTransfer
+
+_spec = importlib.util.spec_from_file_location(
+    "make_data", Path(__file__).parent / "make-data.py"
+)
+make_data = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(make_data)
+
+JOURNAL = "data/uploaded.jsonl"
+
+
+@pytest.fixture(autouse=True)
+def data_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    Path("data").mkdir()
+
+
+def make_client() -> FakeClient:
+    return FakeClient(file_transfer=FakeFileTransfer(source_folder="/upload/{pid.pid}"))
+
+
+def make_datasets(n: int, content: bytes = b"counts") -> list:
+    datasets = []
+    for i in range(n):
+        filename = f"data/raw_{i}.h5"
+        Path(filename).write_bytes(content + str(i).encode())
+        datasets.append(
+            make_data.build_dataset(i, make_data.X_RANGES[0], 915.22, filename, 10)
+        )
+    return datasets
+
+
+def find_in(client: FakeClient):
+    def find_uploaded(key):
+        for pid, dset in client.datasets.items():
+            meta = dset.scientificMetadata or {}
+            if meta.get("upload_key", {}).get("value") == key:
+                return str(pid)
+        return None
+
+    return find_uploaded
+
+
+def upload(client: FakeClient, datasets: list, **kwargs) -> dict:
+    return make_data.upload_datasets_concurrently(
+        datasets,
+        client_factory=lambda: client,
+        find_uploaded=find_in(client),
+        backoff=0.0,
+        journal=JOURNAL,
+        **kwargs,
+    )
+
+
+def failing(method, failures: int, after_call: bool = False):
+    """Wrap method to raise for the first calls, optionally after it succeeded."""
+    calls = []
+
+    def wrapper(*args, **kwargs):
+        calls.append(args)
+        if len(calls) > failures:
+            return method(*args, **kwargs)
+        if after_call:
+            method(*args, **kwargs)
+        raise ScicatCommError("Connection reset")
+
+    wrapper.calls = calls
+    return wrapper
+
+
+def test_uploads_all_datasets_and_records_them_in_journal():
+    client = make_client()
+    pids = upload(client, make_datasets(3))
+    assert sorted(pids.values()) == sorted(str(pid) for pid in client.datasets)
+    entries = [json.loads(line) for line in Path(JOURNAL).read_text().splitlines()]
+    assert {entry["name"]: entry["pid"] for entry in entries} == pids
+
+
+def test_journal_skips_finished_uploads():
+    first = upload(make_client(), make_datasets(3))
+    # A new, empty server shows that only the journal prevents the uploads.
+    client = make_client()
+    assert upload(client, make_datasets(3)) == first
+    assert not client.datasets
+
+
+def test_journal_does_not_skip_datasets_with_changed_files():
+    client = make_client()
+    first = upload(client, make_datasets(2))
+    second = upload(client, make_datasets(2, content=b"other counts"))
+    assert first.keys() == second.keys()
+    assert set(first.values()).isdisjoint(second.values())
+    assert len(client.datasets) == 4
+
+
+def test_datasets_in_scicat_are_not_uploaded_again_without_journal():
+    client = make_client()
+    first = upload(client, make_datasets(3))
+    Path(JOURNAL).unlink()
+    assert upload(client, make_datasets(3)) == first
+    assert len(client.datasets) == 3
+
+
+def test_failed_upload_is_retried(monkeypatch):
+    client = make_client()
+    create = failing(client.scicat.create_dataset_model, failures=2)
+    monkeypatch.setattr(client.scicat, "create_dataset_model", create)
+    pids = upload(client, make_datasets(1))
+    assert len(create.calls) == 3
+    assert list(pids.values()) == [str(pid) for pid in client.datasets]
+
+
+def test_retry_does_not_duplicate_dataset_stored_before_failure(monkeypatch):
+    client = make_client()
+    create = failing(client.scicat.create_dataset_model, failures=1, after_call=True)
+    monkeypatch.setattr(client.scicat, "create_dataset_model", create)
+    pids = upload(client, make_datasets(1))
+    assert len(create.calls) == 1
+    assert list(pids.values()) == [str(pid) for pid in client.datasets]
+
+
+def test_gives_up_after_retries(monkeypatch):
+    client = make_client()
+    create = failing(client.scicat.create_dataset_model, failures=100)
+    monkeypatch.setattr(client.scicat, "create_dataset_model", create)
+    with pytest.raises(RuntimeError, match="Failed to upload 2 datasets"):
+        upload(client, make_datasets(2), retries=3)
+    # One attempt and three retries per dataset.
+    assert len(create.calls) == 8
+    assert not client.datasets
+    assert not Path(JOURNAL).exists()
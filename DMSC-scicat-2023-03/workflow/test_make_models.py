@@ -0,0 +1,128 @@
+"""Tests for make-models.py.
+
+They use an in-memory stand-in for the SciCat server behind ScicatClient.
+Run with `python -m pytest` from the workflow folder.
+"""
+import importlib.util
+import json
+from pathlib import Path
+from urllib.parse import unquote
+
+import pytest
+
+_spec = importlib.util.spec_from_file_location(
+    "make_models", Path(__file__).parent / "make-models.py"
+)
+make_models = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(make_models)
+
+
+class FakeScicatClient:
+    """Stores models by kind and answers the 'inq' filters of find_existing."""
+
+    def __init__(self, fail_keys=()):
+        self.stored = {kind: [] for kind in make_models.MODEL_KINDS}
+        self.queries = []
+        self.fail_keys = set(fail_keys)
+        for kind in make_models.MODEL_KINDS:
+            create = make_models.MODEL_KINDS[kind][3]
+            setattr(self, create, self._creator(kind))
+
+    def _creator(self, kind):
+        key_field = make_models.MODEL_KINDS[kind][2]
+
+        def create(obj):
+            fields = obj.dict(exclude_none=True)
+            if fields[key_field] in self.fail_keys:
+                raise RuntimeError("Internal server error")
+            self.stored[kind].append(fields)
+            return fields[key_field]
+
+        return create
+
+    def _call_endpoint(self, cmd, endpoint, operation):
+        assert cmd == "get"
+        name, query = endpoint.split("?filter=")
+        ((key_field, condition),) = json.loads(unquote(query))["where"].items()
+        (kind,) = (k for k, v in make_models.MODEL_KINDS.items() if v[1] == name)
+        self.queries.append(kind)
+        return [
+            fields
+            for fields in self.stored[kind]
+            if fields[key_field] in condition["inq"]
+        ]
+
+
+def instruments(n: int) -> list:
+    return [{"name": f"Instrument {i}"} for i in range(n)]
+
+
+def test_provision_creates_all_models():
+    client = FakeScicatClient()
+    report = make_models.provision(client, make_models.WORKSHOP_MODELS)
+    for kind, entries in make_models.WORKSHOP_MODELS.items():
+        assert len(client.stored[kind]) == len(entries)
+        assert len(report[kind]["created"]) == len(entries)
+        assert not report[kind]["existing"]
+
+
+def test_second_provision_creates_nothing():
+    client = FakeScicatClient()
+    make_models.provision(client, make_models.WORKSHOP_MODELS)
+    stored = {kind: list(models) for kind, models in client.stored.items()}
+    report = make_models.provision(client, make_models.WORKSHOP_MODELS)
+    assert client.stored == stored
+    for kind, entries in make_models.WORKSHOP_MODELS.items():
+        assert not report[kind]["created"]
+        assert len(report[kind]["existing"]) == len(entries)
+
+
+def test_duplicate_entries_are_created_once():
+    client = FakeScicatClient()
+    report = make_models.provision(client, {"instruments": instruments(2) * 2})
+    assert len(client.stored["instruments"]) == 2
+    assert len(report["instruments"]["existing"]) == 2
+
+
+def test_lookups_are_batched(monkeypatch):
+    monkeypatch.setattr(make_models, "LOOKUP_BATCH_SIZE", 2)
+    client = FakeScicatClient()
+    make_models.provision(client, {"instruments": instruments(5)})
+    assert client.queries == ["instruments"] * 3
+
+
+def test_failed_creates_are_reported_and_do_not_stop_others():
+    client = FakeScicatClient(fail_keys={"Instrument 1", "Instrument 3"})
+    report = make_models.provision(client, {"instruments": instruments(5)})
+    assert sorted(report["instruments"]["failed"]) == ["Instrument 1", "Instrument 3"]
+    assert sorted(report["instruments"]["created"]) == [
+        "Instrument 0",
+        "Instrument 2",
+        "Instrument 4",
+    ]
+
+
+def test_main_exits_with_error_if_a_create_failed(monkeypatch):
+    client = FakeScicatClient(fail_keys={"PeakMeister"})
+    monkeypatch.setattr(make_models, "ScicatClient", lambda *args, **kwargs: client)
+    monkeypatch.setattr("sys.argv", ["make-models.py"])
+    with pytest.raises(SystemExit) as exc_info:
+        make_models.main()
+    assert exc_info.value.code == 1
+    assert len(client.stored["proposals"]) == 1
+    assert len(client.stored["samples"]) == 1
+
+
+def test_make_functions_are_idempotent():
+    client = FakeScicatClient()
+    for _ in range(2):
+        make_models.make_instrument(client)
+        make_models.make_proposal(client)
+        make_models.make_sample(client)
+    assert all(len(models) == 1 for models in client.stored.values())
+
+
+def test_make_function_raises_if_create_failed():
+    client = FakeScicatClient(fail_keys={"PeakMeister"})
+    with pytest.raises(RuntimeError, match="Failed to create instruments"):
+        make_models.make_instrument(client)
@@ -0,0 +1,68 @@
+"""Tests for the batch peak fit in peak_fit.py.
+
+Run with `python -m pytest` from the workflow folder.
+"""
+import numpy as np
+import pytest
+
+import peak_fit
+
+N_SPECTRA = 60
+
+
+@pytest.fixture(scope="module")
+def make_data():
+    return peak_fit._load_make_data()
+
+
+@pytest.fixture(scope="module")
+def fitted(make_data):
+    """Fit spectra of make-data.py and return the fit and the true parameters."""
+    rng = np.random.default_rng(5521)
+    params = [
+        [p[i % len(p)] for i in range(N_SPECTRA)]
+        for p in (
+            make_data.ALL_PEAKS,
+            make_data.BG_SLOPES,
+            make_data.BG_OFFSETS,
+            make_data.X_RANGES,
+            make_data.PROTON_CHARGES,
+        )
+    ]
+    spectra = make_data.build_data_batch(rng, *params)
+    true_peaks = np.array(params[0])
+    initial = true_peaks[:, :, :2].copy()
+    initial[:, :, 0] += rng.uniform(-0.02, 0.02, initial.shape[:2])
+    initial[:, :, 1] *= rng.uniform(0.9, 1.1, initial.shape[:2])
+    fit = peak_fit.fit_peaks(spectra, initial, chunk_size=16)
+    return fit, true_peaks, np.array(params[4])
+
+
+def test_all_fits_converge(fitted):
+    fit, *_ = fitted
+    assert fit.converged.values.all()
+
+
+def test_fit_recovers_peaks_of_make_data(fitted):
+    fit, true_peaks, proton_charge = fitted
+    norm = (
+        1000
+        * proton_charge[:, np.newaxis]
+        / (2 * np.sqrt(2 * np.pi) * fit.peaks["amplitude"].values)
+    )
+    np.testing.assert_allclose(fit.peaks["mu"].values, true_peaks[:, :, 0], atol=0.01)
+    np.testing.assert_allclose(
+        fit.peaks["sigma"].values, true_peaks[:, :, 1], rtol=0.08
+    )
+    np.testing.assert_allclose(norm, true_peaks[:, :, 2], rtol=0.1)
+
+
+def test_uncertainties_match_scatter_of_mu(fitted):
+    fit, true_peaks, _ = fitted
+    pull = (fit.peaks["mu"].values - true_peaks[:, :, 0]) / np.sqrt(
+        fit.peaks["mu"].variances
+    )
+    # The uncertainties of broad peaks that overlap with the background are
+    # underestimated, the width is estimated robustly to not depend on them.
+    width = 1.4826 * np.median(np.abs(pull - np.median(pull)))
+    assert width == pytest.approx(1.0, abs=0.25)
@@ -0,0 +1,55 @@
+"""Tests for the batch reduction in reduction.py.
+
+Run with `python -m pytest` from the workflow folder.
+"""
+import json
+from pathlib import Path
+
+import numpy as np
+import pytest
+import scipp as sc
+
+import reduction
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    rng = np.random.default_rng(8132)
+    entries = []
+    for i, n in enumerate((500, 550, 600, 520, 580)):
+        raw = sc.DataArray(
+            sc.array(dims=["wavelength"], values=rng.uniform(0, 1e4, n), unit="counts"),
+            coords={"wavelength": sc.linspace("wavelength", 0.3, 1.5, n, unit="Å")},
+        )
+        input_file = tmp_path / f"raw_{i}.h5"
+        raw.save_hdf5(input_file)
+        entries.append(
+            {
+                "input": str(input_file),
+                "proton_charge": {"value": 900.0 + 100 * i, "unit": "uAh"},
+            }
+        )
+    return entries
+
+
+@pytest.mark.parametrize("workers", [None, 1, 2])
+def test_batch_output_is_identical_to_single_file_reduction(
+    tmp_path, manifest, workers
+):
+    records = reduction.reduce_manifest(manifest, tmp_path / "batch", workers=workers)
+    assert len(records) == len(manifest)
+    for entry, record_file in zip(manifest, records):
+        stem = Path(entry["input"]).stem
+        single_output = tmp_path / "single" / f"corrected_{stem}.h5"
+        single_output.parent.mkdir(exist_ok=True)
+        expected = reduction.reduce_file(
+            entry["input"], single_output, entry["proton_charge"]
+        )
+
+        record = json.loads(Path(record_file).read_text())
+        assert record["input"] == expected["input"]
+        assert record["meta"] == expected["meta"]
+        assert record["used_software"] == expected["used_software"]
+        assert sc.identical(
+            sc.io.load_hdf5(record["output"]), sc.io.load_hdf5(single_output)
+        )
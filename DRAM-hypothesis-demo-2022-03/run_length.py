@@ -1,9 +1,12 @@
 from hypothesis import example, given, settings, Verbosity
 from hypothesis import strategies as st
+import numpy as np
 
 
 # 'aabccca' -> ('a', 2), ('b', 1), ('c', 3), ('a', 1)
 def encode(input_string):
+    if not input_string:
+        return []
     count = 1
     prev = ''
     lst = []
@@ -22,12 +25,102 @@ def encode(input_string):
 
 
 def decode(lst):
-    q = ''
-    for character, count in lst:
-        q += character * count
-    return q
+    return ''.join(character * count for character, count in lst)
+
+
+# Array versions of the above.
+# They work on any 1d array, e.g. code points of a string or bytes,
+# and return the runs as parallel arrays of values and counts.
+
+
+def to_code_points(s):
+    return np.frombuffer(s.encode('utf-32-le'), dtype=np.uint32)
+
+
+def from_code_points(a):
+    return np.asarray(a, dtype=np.uint32).tobytes().decode('utf-32-le')
+
+
+# [1, 1, 2, 3, 3, 3, 1] -> values=[1, 2, 3, 1], counts=[2, 1, 3, 1]
+def encode_array(a):
+    a = np.asarray(a)
+    if len(a) == 0:
+        return a[:0], np.zeros(0, dtype=np.int64)
+    # Index of the first element of each run.
+    starts = np.flatnonzero(np.concatenate(([True], a[1:] != a[:-1])))
+    counts = np.diff(np.append(starts, len(a)))
+    return a[starts], counts
+
+
+def decode_array(values, counts):
+    # Allocates the output once.
+    return np.repeat(values, counts)
+
+
+# Encode chunks of a long input one after the other.
+# Yields (values, counts) for each chunk. The last run of a chunk is held back
+# until the next chunk is known to start with a different value.
+def encode_stream(chunks):
+    pending = None
+    for chunk in chunks:
+        values, counts = encode_array(chunk)
+        if len(values) == 0:
+            continue
+        if pending is not None:
+            pending_value, pending_count = pending
+            if values[0] == pending_value[0]:
+                counts[0] += pending_count[0]
+            else:
+                values = np.concatenate((pending_value, values))
+                counts = np.concatenate((pending_count, counts))
+        pending = values[-1:], counts[-1:]
+        if len(values) > 1:
+            yield values[:-1], counts[:-1]
+    if pending is not None:
+        yield pending
+
+
+def decode_stream(runs):
+    for values, counts in runs:
+        yield decode_array(values, counts)
+
+
+def chunked(a, size):
+    for begin in range(0, len(a), size):
+        yield a[begin:begin + size]
 
 
 @given(st.text())
 def test_decode_inverts_encode(s):
     assert decode(encode(s)) == s
+
+
+@given(st.text())
+@example('')
+def test_encode_array_matches_encode(s):
+    values, counts = encode_array(to_code_points(s))
+    assert list(zip(from_code_points(values), counts)) == encode(s)
+
+
+@given(st.text())
+def test_decode_array_inverts_encode_array(s):
+    assert from_code_points(decode_array(*encode_array(to_code_points(s)))) == s
+
+
+@given(st.binary())
+def test_decode_array_inverts_encode_array_bytes(b):
+    a = np.frombuffer(b, dtype=np.uint8)
+    assert decode_array(*encode_array(a)).tobytes() == b
+
+
+@given(st.text(), st.integers(min_value=1, max_value=10))
+@example('aabb', 2)
+def test_decode_stream_inverts_encode_stream(s, chunk_size):
+    a = to_code_points(s)
+    runs = list(encode_stream(chunked(a, chunk_size)))
+    # Runs spanning several chunks must be merged, i.e., the result is the same
+    # as encoding everything at once.
+    values, counts = encode_array(a)
+    assert np.array_equal(np.concatenate([values[:0]] + [v for v, _ in runs]), values)
+    assert np.array_equal(np.concatenate([counts[:0]] + [c for _, c in runs]), counts)
+    assert ''.join(map(from_code_points, decode_stream(runs))) == s
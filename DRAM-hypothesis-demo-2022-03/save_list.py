@@ -1,19 +1,142 @@
-from io import StringIO
+from io import BytesIO, SEEK_END, StringIO
+import re
+import struct
+import time
 
 from hypothesis import given, settings, example
 from hypothesis import strategies as st
 
 
-def save_list(data, f):
+# Formats that work for all strings and do not need the whole file in memory.
+# Writes are collected into batches of about BATCH_SIZE bytes or characters.
+BATCH_SIZE = 1 << 16
+
+
+# Binary: each element is stored as its length in bytes (uint32) followed by
+# its utf-8 encoding. The elements are terminated by END.
+# With index=True, a footer with the offset of each element follows which
+# allows loading single elements, see load_element_binary.
+# The footer must be at the end of the file.
+_LENGTH = struct.Struct('<I')
+_OFFSET = struct.Struct('<Q')
+# number of elements, bytes from the first element to END inclusive, magic
+_FOOTER = struct.Struct('<QQ8s')
+_MAGIC = b'LISTIDX1'
+END = 0xFFFFFFFF
+
+
+def save_list_binary(data, f, index=False):
+    batch = []
+    batch_size = 0
+    offsets = []
+    offset = 0
     for element in data:
-        f.write(element + ',')
+        encoded = element.encode('utf-8')
+        if len(encoded) >= END:
+            raise ValueError('Element is too long')
+        if index:
+            offsets.append(offset)
+        batch.append(_LENGTH.pack(len(encoded)))
+        batch.append(encoded)
+        batch_size += _LENGTH.size + len(encoded)
+        offset += _LENGTH.size + len(encoded)
+        if batch_size >= BATCH_SIZE:
+            f.write(b''.join(batch))
+            batch = []
+            batch_size = 0
+    batch.append(_LENGTH.pack(END))
+    f.write(b''.join(batch))
+    if index:
+        f.write(struct.pack(f'<{len(offsets)}Q', *offsets))
+        f.write(_FOOTER.pack(len(offsets), offset + _LENGTH.size, _MAGIC))
+
+
+def iter_list_binary(f):
+    buffer = b''
+    pos = 0
+    while True:
+        if len(buffer) - pos < _LENGTH.size:
+            buffer = buffer[pos:] + f.read(BATCH_SIZE)
+            pos = 0
+            if len(buffer) < _LENGTH.size:
+                raise EOFError('List is truncated')
+        (length,) = _LENGTH.unpack_from(buffer, pos)
+        pos += _LENGTH.size
+        if length == END:
+            return
+        if len(buffer) - pos < length:
+            buffer = buffer[pos:] + f.read(max(length, BATCH_SIZE))
+            pos = 0
+            if len(buffer) < length:
+                raise EOFError('List is truncated')
+        yield buffer[pos:pos + length].decode('utf-8')
+        pos += length
+
+
+def load_element_binary(f, i):
+    f.seek(-_FOOTER.size, SEEK_END)
+    n, size, magic = _FOOTER.unpack(f.read(_FOOTER.size))
+    if magic != _MAGIC:
+        raise ValueError('List was saved without index')
+    if not -n <= i < n:
+        raise IndexError('List index out of range')
+    offsets_start = f.tell() - _FOOTER.size - n * _OFFSET.size
+    f.seek(offsets_start + (i % n) * _OFFSET.size)
+    (offset,) = _OFFSET.unpack(f.read(_OFFSET.size))
+    f.seek(offsets_start - size + offset)
+    (length,) = _LENGTH.unpack(f.read(_LENGTH.size))
+    return f.read(length).decode('utf-8')
+
+
+# Text: one element per line. Backslashes and line breaks are escaped such that
+# elements cannot contain a line break.
+# Random access is not supported because text files cannot seek to arbitrary
+# offsets.
+_ESCAPE = {'\\': '\\\\', '\n': '\\n', '\r': '\\r'}
+_UNESCAPE = {escaped: character for character, escaped in _ESCAPE.items()}
+_ESCAPED = re.compile(r'\\.', re.DOTALL)
+
+
+def _escape(element):
+    for character, escaped in _ESCAPE.items():
+        element = element.replace(character, escaped)
+    return element
+
+
+def _unescape(line):
+    return _ESCAPED.sub(lambda match: _UNESCAPE[match.group()], line)
+
+
+def save_list_text(data, f):
+    batch = []
+    batch_size = 0
+    for element in data:
+        line = _escape(element) + '\n'
+        batch.append(line)
+        batch_size += len(line)
+        if batch_size >= BATCH_SIZE:
+            f.write(''.join(batch))
+            batch = []
+            batch_size = 0
+    f.write(''.join(batch))
+
+
+def iter_list_text(f):
+    for line in f:
+        if not line.endswith('\n'):
+            raise EOFError('List is truncated')
+        line = line[:-1]
+        yield _unescape(line) if '\\' in line else line
+
+
+# The original version wrote element + ',' and split on ',' when loading which
+# fails for elements containing a comma, see the example below.
+def save_list(data, f):
+    save_list_text(data, f)
 
 
 def load_list(f):
-    # initial:
-    # return f.read().split(',')[:-1]
-    # improved but still faulty
-    return f.read().split(',')[:-1]
+    return list(iter_list_text(f))
 
 
 # # initial
@@ -47,3 +170,54 @@ def test_roundtrip(data):
     loaded = load_list(f)
     assert loaded == data
 
+
+@given(st.lists(st.text()))
+@example([','])
+@example(['a\\', 'n\n', '\r\n', '\\n'])
+def test_roundtrip_binary(data):
+    f = BytesIO()
+    save_list_binary(data, f)
+    f.seek(0)
+    loaded = list(iter_list_binary(f))
+    assert loaded == data
+
+
+@given(st.lists(st.text()))
+@example([','])
+@example(['a\\', 'n\n', '\r\n', '\\n'])
+def test_roundtrip_text(data):
+    f = StringIO()
+    save_list_text(data, f)
+    f.seek(0)
+    loaded = list(iter_list_text(f))
+    assert loaded == data
+
+
+@given(st.lists(st.text(), min_size=1), st.data())
+def test_load_element_binary(data, draw):
+    f = BytesIO()
+    save_list_binary(data, f, index=True)
+    f.seek(0)
+    assert list(iter_list_binary(f)) == data
+    i = draw.draw(st.integers(min_value=-len(data), max_value=len(data) - 1))
+    assert load_element_binary(f, i) == data[i]
+
+
+def benchmark(n=10_000_000):
+    data = [f'element {i}, with a comma' for i in range(n)]
+    for name, save, load, f in (
+        ('binary', save_list_binary, iter_list_binary, BytesIO()),
+        ('text', save_list_text, iter_list_text, StringIO()),
+    ):
+        start = time.perf_counter()
+        save(data, f)
+        saved = time.perf_counter()
+        f.seek(0)
+        for _ in load(f):
+            pass
+        loaded = time.perf_counter()
+        print(f'{name}: save {saved - start:.2f}s, load {loaded - saved:.2f}s')
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,182 @@
+"""
+Benchmark prefilter and remove_events of prepare_exercise_data_rhessi.py
+on synthetic flares.
+
+Run
+    python benchmark_rhessi.py --size 10000000
+to measure the time and the peak memory of prefilter and remove_events
+for 10M flares and the scaling of remove_events with the number of flares.
+prefilter is compared with the chain of selections it replaced
+and remove_events with its legacy implementation.
+
+Every measurement runs in a fresh process.
+The peak RSS is reported relative to the RSS after making the input,
+see profiling.reset_peak_rss. This needs Linux.
+"""
+
+from __future__ import annotations
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import ctypes
+import gc
+import time
+from typing import Optional, Tuple
+
+import numpy as np
+import scipp as sc
+
+from prepare_exercise_data_rhessi import (
+    ECLIPSED_FLAGS,
+    FLAGS,
+    any_flag,
+    make_flare_array,
+    prefilter,
+    remove_events,
+)
+import profiling
+
+# About 20 years in seconds.
+TIME_SPAN = 20 * 365 * 24 * 3600
+
+
+def synthetic_flares(
+    rng: np.random.Generator, n: int, packed_flags: bool = False
+) -> sc.DataArray:
+    """
+    Flares with the columns of load_txt_file_streaming and random values.
+
+    Each flag is set with a probability of 5% and about half of the flares
+    pass prefilter.
+    The flares are sorted by peak_time like the flare list.
+    """
+    peak_time = np.sort(rng.integers(0, TIME_SPAN, n)).astype("datetime64[s]")
+    duration = rng.integers(10, 3600, n).astype("timedelta64[s]")
+    start_time = peak_time - duration // 2
+    flags = np.zeros(n, dtype=np.int32)
+    for i in range(len(FLAGS)):
+        flags |= (rng.random(n) < 0.05).astype(np.int32) << i
+    energy = np.array([[3.0, 6.0], [6.0, 12.0], [12.0, 25.0], [25.0, 50.0]])
+    values = {
+        "flare_id": np.arange(n, dtype=np.int64),
+        "peak_time": peak_time,
+        "start_time": start_time,
+        "end_time": start_time + duration,
+        "total_counts": rng.exponential(1e4, n),
+        "energy_range": energy[rng.integers(0, len(energy), n)],
+        "x": rng.uniform(-1500, 1500, n),
+        "y": rng.uniform(-1000, 1000, n),
+        "radial": rng.uniform(0, 1800, n),
+        "quality": rng.integers(-1, 5, n),
+        "flags": flags,
+    }
+    return make_flare_array(values, packed_flags)
+
+
+def prefilter_chained(da):
+    """prefilter before its selections were fused, for comparison."""
+    da = da.copy()
+    del da.coords["total_counts"]
+    del da.coords["radial"]
+    del da.attrs["flare_id"]
+    if "flags" in da.attrs:
+        flags = da.attrs.pop("flags")
+        da.attrs["non_solar"] = any_flag(flags, "NS")
+        # PS - see below
+        da = da[~any_flag(flags, *ECLIPSED_FLAGS, "PS")]
+    else:
+        da = da[~da.attrs.pop("eclipsed")]
+    # no quality flag
+    da = da[da.attrs["quality"] >= sc.index(0)]
+    # only high quality
+    da = da[da.attrs["quality"] < sc.index(3)]
+    del da.attrs["quality"]
+    # PS - Possible Solar Flare; in front detectors, but no position
+    if "PS" in da.attrs:
+        da = da[~da.attrs.pop("PS")]
+
+    for flag in FLAGS:
+        try:
+            del da.attrs[flag]
+        except KeyError:
+            pass
+    return da
+
+
+def _release_free_memory() -> None:
+    """
+    Return freed heap memory to the OS.
+
+    Otherwise the temporaries of making the input stay resident and are
+    reused by the measured call without increasing the RSS.
+    """
+    gc.collect()
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        # Not glibc.
+        pass
+
+
+def _measure(
+    func: str, n: int, seed: int, legacy: bool
+) -> Tuple[float, Optional[int], int]:
+    """Return the time, extra peak RSS, and number of output rows of one call."""
+    rng = np.random.default_rng(seed)
+    da = synthetic_flares(rng, n)
+    _release_free_memory()
+    base = profiling.current_rss() if profiling.reset_peak_rss() else None
+    start = time.perf_counter()
+    if func == "prefilter":
+        out = prefilter(da)
+    elif func == "prefilter_chained":
+        out = prefilter_chained(da)
+    else:
+        out = remove_events(da, rng, legacy=legacy)
+    elapsed = time.perf_counter() - start
+    extra = None if base is None else profiling.peak_rss() - base
+    return elapsed, extra, out.sizes["flare"]
+
+
+def measure(func: str, n: int, seed: int = 9274, legacy: bool = False) -> str:
+    with ProcessPoolExecutor(max_workers=1) as pool:
+        elapsed, rss, rows = pool.submit(_measure, func, n, seed, legacy).result()
+    name = f"{func}(legacy=True)" if legacy else func
+    rss = "unknown" if rss is None else f"{rss / 1024**2:.0f} MiB"
+    return (
+        f"{name} {n:.0e} flares -> {rows}: {elapsed:.2f}s"
+        f" ({elapsed / n * 1e9:.0f} ns per flare), extra peak RSS {rss}"
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the RHESSI preparation")
+    parser.add_argument(
+        "--size", type=int, default=10_000_000, help="Number of flares for prefilter"
+    )
+    parser.add_argument(
+        "--scaling-sizes",
+        type=float,
+        nargs="*",
+        default=[1e5, 1e6, 1e7],
+        help="Numbers of flares for the scaling of remove_events",
+    )
+    parser.add_argument(
+        "--legacy-size",
+        type=int,
+        default=1_000_000,
+        help="Number of flares for the comparison with remove_events(legacy=True)",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    print(measure("prefilter", args.size))
+    print(measure("prefilter_chained", args.size))
+    print(measure("remove_events", args.legacy_size, legacy=True))
+    for n in args.scaling_sizes:
+        print(measure("remove_events", int(n)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""
+Export data arrays to a directory with one .npy file per variable.
+
+The directory also contains 'schema.json' with the dims, units, and dtypes
+of all variables.
+`load_columns` memory-maps the files which lets many processes share the
+same pages of the OS page cache.
+Scipp cannot wrap memory that it does not own, so `load_data_array` copies
+the requested columns into a data array.
+Use `load_columns` and `columns=...` to keep the resident memory small.
+
+Scalar strings are stored in the schema and scalar data arrays
+(e.g., the detector efficiency) in subdirectories.
+Broadcast variables like the data in compact mode are stored as a single
+value.
+"""
+
+from __future__ import annotations
+import json
+from pathlib import Path
+import shutil
+from typing import Any, Dict, Iterable, Optional, Union
+
+import numpy as np
+import scipp as sc
+
+SCHEMA_FILE = "schema.json"
+SCHEMA_VERSION = 1
+
+
+def _unit_to_json(unit: Optional[sc.Unit]) -> Optional[dict]:
+    return None if unit is None else unit.to_dict()
+
+
+def _unit_from_json(unit: Optional[dict]) -> Optional[sc.Unit]:
+    return None if unit is None else sc.Unit.from_dict(unit)
+
+
+def _file_name(section: str, name: str) -> str:
+    return f"{section}.{name.replace('/', '_')}"
+
+
+def _export_variable(path: Path, section: str, name: str, var: sc.Variable) -> dict:
+    entry = {"dims": list(var.dims), "unit": _unit_to_json(var.unit)}
+    entry["dtype"] = str(var.dtype)
+    if var.dtype == sc.DType.DataArray:
+        entry["directory"] = _file_name(section, name)
+        export_columns(var.value, path / entry["directory"])
+    elif not var.dims:
+        if var.dtype != sc.DType.string:
+            raise sc.DTypeError(f"Cannot export scalar {name} of {var.dtype}")
+        entry["value"] = var.value
+    elif var.dtype not in (sc.DType.string, sc.DType.datetime64) and (
+        0 in var.values.strides
+    ):
+        # Broadcast, store only one element.
+        entry["shape"] = list(var.shape)
+        entry["value"] = var.values.flat[0].item()
+    else:
+        entry["file"] = _file_name(section, name) + ".npy"
+        values = var.values
+        if var.dtype == sc.DType.string:
+            # Fixed width such that the file can be memory-mapped.
+            values = np.asarray(values, dtype=str)
+        np.save(path / entry["file"], np.ascontiguousarray(values), allow_pickle=False)
+    return entry
+
+
+def export_columns(da: sc.DataArray, path: Union[str, Path]) -> None:
+    """Write da to the directory at path, replacing its previous contents."""
+    path = Path(path)
+    tmp = path.with_name(f".{path.name}.tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    schema = {
+        "version": SCHEMA_VERSION,
+        "name": da.name,
+        "data": _export_variable(tmp, "data", "data", da.data),
+    }
+    for section in ("coords", "attrs", "masks"):
+        schema[section] = {
+            name: _export_variable(tmp, section, name, var)
+            for name, var in getattr(da, section).items()
+        }
+    (tmp / SCHEMA_FILE).write_text(json.dumps(schema, indent=1))
+    shutil.rmtree(path, ignore_errors=True)
+    tmp.rename(path)
+
+
+def read_schema(path: Union[str, Path]) -> Dict[str, Any]:
+    schema = json.loads((Path(path) / SCHEMA_FILE).read_text())
+    if schema["version"] != SCHEMA_VERSION:
+        raise ValueError(f"Unsupported column store version {schema['version']}")
+    return schema
+
+
+def _load_values(path: Path, entry: dict) -> np.ndarray:
+    if "file" in entry:
+        return np.load(path / entry["file"], mmap_mode="r")
+    return np.broadcast_to(
+        np.array(entry["value"], dtype=entry["dtype"]), entry["shape"]
+    )
+
+
+def load_columns(
+    path: Union[str, Path], columns: Optional[Iterable[str]] = None
+) -> Dict[str, np.ndarray]:
+    """
+    Return read-only, memory-mapped arrays of the data and the given coords,
+    attrs, and masks without copying them.
+
+    The data is returned under the key 'data'.
+    Scalars are not included.
+    """
+    path = Path(path)
+    schema = read_schema(path)
+    out = {"data": _load_values(path, schema["data"])}
+    for section in ("coords", "attrs", "masks"):
+        for name, entry in schema[section].items():
+            if entry["dims"] and (columns is None or name in columns):
+                out[name] = _load_values(path, entry)
+    return out
+
+
+def _load_variable(path: Path, entry: dict) -> sc.Variable:
+    unit = _unit_from_json(entry["unit"])
+    if "directory" in entry:
+        return sc.scalar(load_data_array(path / entry["directory"]))
+    if not entry["dims"]:
+        return sc.scalar(entry["value"], unit=unit)
+    values = _load_values(path, entry)
+    if 0 in values.strides:
+        return sc.broadcast(
+            sc.scalar(values.flat[0], unit=unit, dtype=entry["dtype"]),
+            sizes=dict(zip(entry["dims"], entry["shape"])),
+        )
+    return sc.array(dims=entry["dims"], values=values, unit=unit)
+
+
+def load_data_array(
+    path: Union[str, Path], columns: Optional[Iterable[str]] = None
+) -> sc.DataArray:
+    """
+    Load the data and the given coords, attrs, and masks, by default all.
+
+    Scalar attrs are always loaded.
+    """
+    path = Path(path)
+    schema = read_schema(path)
+    contents = {}
+    for section in ("coords", "attrs", "masks"):
+        contents[section] = {
+            name: _load_variable(path, entry)
+            for name, entry in schema[section].items()
+            if not entry["dims"] or columns is None or name in columns
+        }
+    return sc.DataArray(
+        _load_variable(path, schema["data"]), name=schema["name"], **contents
+    )
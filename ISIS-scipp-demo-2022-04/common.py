@@ -1,24 +1,33 @@
-from datetime import date, datetime, time, timedelta
-from typing import Dict, Union
+from datetime import date, datetime, time, timedelta, timezone
+import io
+from typing import Dict, Tuple, Union
 
+import h5py
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import scipp as sc
+
+MONTHS = (
+    "Jan",
+    "Feb",
+    "Mar",
+    "Apr",
+    "May",
+    "Jun",
+    "Jul",
+    "Aug",
+    "Sep",
+    "Oct",
+    "Nov",
+    "Dec",
+)
+
+
+_MONTH_NUMBERS = {name: i + 1 for i, name in enumerate(MONTHS)}
 
 
 def parse_month(m) -> int:
-    return [
-        "Jan",
-        "Feb",
-        "Mar",
-        "Apr",
-        "May",
-        "Jun",
-        "Jul",
-        "Aug",
-        "Sep",
-        "Oct",
-        "Nov",
-        "Dec",
-    ].index(m) + 1
+    return _MONTH_NUMBERS[m]
 
 
 def parse_date(d) -> date:
@@ -36,11 +45,12 @@ def parse_datetimes(d, start, peak, end) -> Dict[str, Union[np.datetime64, int]]
     peak = parse_time(peak)
     end = parse_time(end)
 
-    start_datetime = datetime.combine(d, start)
+    # The flare lists are in UTC, do not let the local timezone leak in.
+    start_datetime = datetime.combine(d, start, tzinfo=timezone.utc)
     peak_date = d + timedelta(days=1) if peak < start else d
-    peak_datetime = datetime.combine(peak_date, peak)
+    peak_datetime = datetime.combine(peak_date, peak, tzinfo=timezone.utc)
     end_date = d + timedelta(days=1) if end < start else d
-    end_datetime = datetime.combine(end_date, end)
+    end_datetime = datetime.combine(end_date, end, tzinfo=timezone.utc)
 
     return {
         "peak_time": np.datetime64(int(peak_datetime.timestamp()), "s"),
@@ -48,3 +58,206 @@ def parse_datetimes(d, start, peak, end) -> Dict[str, Union[np.datetime64, int]]
         "end_time": np.datetime64(int(end_datetime.timestamp()), "s"),
         "duration": int((end_datetime - start_datetime).total_seconds()),
     }
+
+
+# Vectorized versions of the parsers above.
+# They operate on arrays of byte strings (numpy dtype 'S') as produced by
+# splitting a whole file at once and avoid creating Python objects per row.
+
+
+def tokenize(buffer: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Split a buffer of bytes into whitespace separated tokens.
+
+    All control characters count as whitespace.
+    Returns the start and end offsets of all tokens and the number of tokens
+    in each line.
+    """
+    is_token = buffer > ord(" ")
+    token_starts, token_ends = np.flatnonzero(
+        np.diff(np.r_[False, is_token, False])
+    ).reshape(2, -1, order="F")
+    line_ends = np.r_[np.flatnonzero(buffer == ord("\n")), len(buffer)]
+    tokens_per_line = np.diff(np.searchsorted(token_starts, line_ends), prepend=0)
+    return token_starts, token_ends, tokens_per_line
+
+
+def first_blank_line(tokens_per_line: np.ndarray) -> int:
+    """Return the index of the first line without tokens or the number of lines."""
+    blank_lines = np.flatnonzero(tokens_per_line == 0)
+    return int(blank_lines[0]) if len(blank_lines) else len(tokens_per_line)
+
+
+def token_column(
+    buffer: np.ndarray, starts: np.ndarray, ends: np.ndarray
+) -> np.ndarray:
+    """Extract the tokens at the given offsets into an array of byte strings."""
+    lengths = ends - starts
+    width = max(int(np.max(lengths, initial=0)), 1)
+    padded = np.r_[buffer, np.zeros(width, dtype=np.uint8)]
+    chars = sliding_window_view(padded, width)[starts]
+    if np.any(lengths < width):
+        chars[np.arange(width) >= lengths[:, np.newaxis]] = 0
+    return chars.view(f"S{width}")[:, 0]
+
+
+def _as_chars(a: np.ndarray, width: int) -> np.ndarray:
+    """Return a 2d uint8 array with one row of `width` characters per string."""
+    a = np.asarray(a)
+    if a.dtype.kind == "U":
+        a = a.astype("S")
+    return a.astype(f"S{width}").view(np.uint8).reshape(len(a), width)
+
+
+def parse_digits(chars: np.ndarray, start: int, stop: int) -> np.ndarray:
+    """Parse columns [start, stop) of a 2d character array as decimal integers."""
+    value = np.zeros(len(chars), dtype=np.int64)
+    for i in range(start, stop):
+        # Wraps around for characters below '0'.
+        digit = chars[:, i] - np.uint8(ord("0"))
+        if np.any(digit > 9):
+            raise ValueError(f"Expected digits in columns {start}:{stop}")
+        value *= 10
+        value += digit
+    return value
+
+
+_MONTH_KEYS = np.array(
+    [int.from_bytes(m.encode("ascii"), "big") for m in MONTHS], dtype=np.int64
+)
+
+
+def parse_date_array(d: np.ndarray) -> np.ndarray:
+    """Parse an array of dates like '05-Jan-2010' into datetime64[D]."""
+    chars = _as_chars(d, 11)
+    # Single digit days are allowed by parse_date, pad them with a zero.
+    short = chars[:, 1] == ord("-")
+    if np.any(short):
+        chars = chars.copy()
+        chars[short, 1:] = chars[short, :-1]
+        chars[short, 0] = ord("0")
+    if np.any(chars[:, 2] != ord("-")) or np.any(chars[:, 6] != ord("-")):
+        raise ValueError("Expected dates of the form DD-Mon-YYYY")
+
+    day = parse_digits(chars, 0, 2)
+    month_key = chars[:, 3:6].astype(np.int64) @ np.array([1 << 16, 1 << 8, 1])
+    month = np.full(len(chars), -1, dtype=np.int64)
+    for i, key in enumerate(_MONTH_KEYS):
+        month[month_key == key] = i
+    if np.any(month < 0):
+        raise ValueError("Unknown month name")
+    year = parse_digits(chars, 7, 11)
+
+    if len(year) == 0:
+        return np.array([], dtype="datetime64[D]")
+    # Look up the first day of each month instead of converting every element.
+    first_year = year.min()
+    first_days = np.arange(
+        np.datetime64(int(first_year) - 1970, "Y"),
+        np.datetime64(int(year.max()) - 1970 + 1, "Y"),
+        dtype="datetime64[M]",
+    ).astype("datetime64[D]")
+    return first_days[(year - first_year) * 12 + month] + (day - 1).astype(
+        "timedelta64[D]"
+    )
+
+
+def parse_time_array(t: np.ndarray) -> np.ndarray:
+    """Parse an array of times like '12:34' or '12:34:56' into seconds of the day."""
+    chars = _as_chars(t, 8)
+    if np.any(chars[:, 2] != ord(":")):
+        raise ValueError("Expected times of the form HH:MM[:SS]")
+    seconds = 3600 * parse_digits(chars, 0, 2) + 60 * parse_digits(chars, 3, 5)
+    has_seconds = chars[:, 5] == ord(":")
+    if np.any(has_seconds):
+        seconds[has_seconds] += parse_digits(chars[has_seconds], 6, 8)
+    return seconds.astype("timedelta64[s]")
+
+
+def parse_datetimes_batch(d, start, peak, end) -> Dict[str, np.ndarray]:
+    """
+    Vectorized version of parse_datetimes.
+
+    Takes arrays of strings and returns arrays with the same values as calling
+    parse_datetimes on every element.
+    """
+    day = parse_date_array(d).astype("datetime64[s]")
+    start = parse_time_array(start)
+    peak = parse_time_array(peak)
+    end = parse_time_array(end)
+
+    one_day = np.timedelta64(1, "D")
+    no_day = np.timedelta64(0, "D")
+    start_time = day + start
+    peak_time = day + peak + np.where(peak < start, one_day, no_day)
+    end_time = day + end + np.where(end < start, one_day, no_day)
+
+    return {
+        "peak_time": peak_time,
+        "start_time": start_time,
+        "end_time": end_time,
+        "duration": (end_time - start_time).astype(np.int64),
+    }
+
+
+# Helpers for the compact output mode of the prepare scripts.
+
+
+def compact_ones(sizes: Dict[str, int], unit) -> sc.Variable:
+    """All ones, backed by a single float32 value instead of one per element."""
+    return sc.broadcast(sc.scalar(1.0, dtype="float32", unit=unit), sizes=sizes)
+
+
+def check_round_trip(
+    expected: sc.DataArray, actual: sc.DataArray, skip: Tuple[str, ...] = ()
+) -> None:
+    """
+    Raise ValueError if actual does not contain the same data as expected.
+
+    dtypes may differ. Floats must be equal within the precision of float32.
+    Coords, attrs, and masks named in skip are not compared.
+    """
+
+    def check(what: str, a: sc.Variable, b: sc.Variable):
+        if a.dims != b.dims or a.shape != b.shape or a.unit != b.unit:
+            raise ValueError(f"Round trip changed the shape or unit of {what}")
+        if a.dtype in (sc.DType.float32, sc.DType.float64):
+            equal = np.allclose(
+                a.values, b.values, rtol=np.finfo(np.float32).eps, atol=0
+            )
+        elif a.dtype == sc.DType.DataArray:
+            equal = sc.identical(a, b)
+        else:
+            equal = np.array_equal(a.values, b.values)
+        if not equal:
+            raise ValueError(f"Round trip changed the values of {what}")
+
+    check("data", expected.data, actual.data)
+    for section in ("coords", "attrs", "masks"):
+        for name, var in getattr(expected, section).items():
+            if name not in skip:
+                check(f"{section[:-1]} '{name}'", var, getattr(actual, section)[name])
+
+
+# scipp can only read and write whole HDF5 files with its public API.
+# These go through an in-memory file to store objects in groups of larger files.
+
+
+def write_scipp_group(group: h5py.Group, obj) -> None:
+    """Write a scipp object into an existing, empty HDF5 group."""
+    buffer = io.BytesIO()
+    obj.save_hdf5(buffer)
+    with h5py.File(buffer, "r") as f:
+        for name in f:
+            f.copy(f[name], group)
+        group.attrs.update(f.attrs)
+
+
+def read_scipp_group(group: h5py.Group):
+    """Read a scipp object from a group written by write_scipp_group or scipp."""
+    buffer = io.BytesIO()
+    with h5py.File(buffer, "w") as f:
+        for name in group:
+            group.copy(group[name], f)
+        f.attrs.update(group.attrs)
+    return sc.io.load_hdf5(buffer)
@@ -0,0 +1,227 @@
+"""
+Match flares in the GOES and RHESSI catalogs whose time intervals overlap.
+
+The catalogs are sorted by start time and candidates are found with binary
+searches, see match_intervals.
+The cost is proportional to the number of events plus the number of
+candidate pairs instead of the product of the catalog sizes.
+
+Run this file to compare with a brute-force implementation:
+    python crossmatch.py --size 1000000
+"""
+
+from __future__ import annotations
+import argparse
+import time
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+import scipp as sc
+
+# Upper limit for the number of candidate pairs held in memory at once.
+MAX_CANDIDATES = 1 << 22
+
+
+def goes_intervals(goes: sc.DataArray) -> Tuple[np.ndarray, np.ndarray]:
+    """Return (start, end) in seconds for the GOES flares."""
+    return _seconds(goes.coords["start_time"]), _seconds(goes.coords["end_time"])
+
+
+def rhessi_intervals(rhessi: sc.DataArray) -> Tuple[np.ndarray, np.ndarray]:
+    """Return (start, end) in seconds for the RHESSI flares."""
+    return _seconds(rhessi.coords["start_time"]), _seconds(rhessi.coords["end_time"])
+
+
+def _seconds(var: sc.Variable) -> np.ndarray:
+    return var.values.astype("datetime64[s]").astype(np.int64)
+
+
+def _duration_classes(duration: np.ndarray) -> np.ndarray:
+    """Group intervals by the power of two of their duration."""
+    return np.ceil(np.log2(np.maximum(duration, 1))).astype(np.int64)
+
+
+def _chunks(counts: np.ndarray) -> Iterator[slice]:
+    """Split rows such that each chunk has at most about MAX_CANDIDATES counts."""
+    total = np.cumsum(counts)
+    begin = 0
+    while begin < len(counts):
+        offset = total[begin - 1] if begin else 0
+        end = int(np.searchsorted(total, offset + MAX_CANDIDATES, side="right"))
+        end = max(end, begin + 1)
+        yield slice(begin, end)
+        begin = end
+
+
+def match_intervals(
+    start_a: np.ndarray,
+    end_a: np.ndarray,
+    start_b: np.ndarray,
+    end_b: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Find all pairs of overlapping intervals [start, end).
+
+    Returns (index_a, index_b, overlap) sorted by index_a and index_b.
+    The inputs can be in any order.
+
+    Intervals in b are grouped by duration class (powers of two).
+    Within a class, b is sorted by start and the candidates for an interval
+    in a are the b that start in (start_a - longest_b, end_a).
+    This bounds the number of false candidates per a by the number of b in
+    a window of twice the length of the class, even if some intervals in
+    the catalog are very long.
+    """
+    start_a, end_a = np.asarray(start_a), np.asarray(end_a)
+    start_b, end_b = np.asarray(start_b), np.asarray(end_b)
+    # Binary searches are much faster with sorted queries.
+    order_a = np.argsort(start_a, kind="stable")
+    sorted_start_a, sorted_end_a = start_a[order_a], end_a[order_a]
+    classes = _duration_classes(end_b - start_b)
+    matched_a, matched_b = [], []
+    for cls in np.unique(classes):
+        in_class = np.flatnonzero(classes == cls)
+        order = in_class[np.argsort(start_b[in_class], kind="stable")]
+        sorted_start = start_b[order]
+        longest = (end_b[order] - sorted_start).max()
+        lo = np.searchsorted(sorted_start, sorted_start_a - longest, side="right")
+        hi = np.searchsorted(sorted_start, sorted_end_a, side="left")
+        counts = np.maximum(hi - lo, 0)
+        for rows in _chunks(counts):
+            n = counts[rows]
+            ia = np.repeat(order_a[rows], n)
+            # Position of each candidate in sorted b.
+            first = np.repeat(lo[rows], n)
+            within = np.arange(len(ia)) - np.repeat(np.cumsum(n) - n, n)
+            ib = order[first + within]
+            overlaps = (end_b[ib] > start_a[ia]) & (start_b[ib] < end_a[ia])
+            matched_a.append(ia[overlaps])
+            matched_b.append(ib[overlaps])
+
+    index_a = np.concatenate([np.zeros(0, dtype=np.int64), *matched_a])
+    index_b = np.concatenate([np.zeros(0, dtype=np.int64), *matched_b])
+    order = np.argsort(index_a * len(start_b) + index_b)
+    index_a, index_b = index_a[order], index_b[order]
+    overlap = np.minimum(end_a[index_a], end_b[index_b]) - np.maximum(
+        start_a[index_a], start_b[index_b]
+    )
+    return index_a, index_b, overlap
+
+
+def match_intervals_brute_force(
+    start_a: np.ndarray,
+    end_a: np.ndarray,
+    start_b: np.ndarray,
+    end_b: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Reference implementation of match_intervals which compares all pairs."""
+    index_a, index_b = [], []
+    for i in range(len(start_a)):
+        (js,) = np.nonzero((end_b > start_a[i]) & (start_b < end_a[i]))
+        index_a.append(np.full(len(js), i))
+        index_b.append(js)
+    index_a = np.concatenate([np.zeros(0, dtype=np.int64), *index_a])
+    index_b = np.concatenate([np.zeros(0, dtype=np.int64), *index_b])
+    overlap = np.minimum(end_a[index_a], end_b[index_b]) - np.maximum(
+        start_a[index_a], start_b[index_b]
+    )
+    return index_a, index_b, overlap
+
+
+def cross_match(
+    goes: sc.DataArray,
+    rhessi: sc.DataArray,
+    max_distance: Optional[sc.Variable] = None,
+) -> sc.DataArray:
+    """
+    Match RHESSI flares to GOES events with overlapping time intervals.
+
+    If max_distance is given, only pairs whose x/y positions are at most this
+    far apart are returned.
+    Returns a data array with dim 'match' with the overlap duration as data
+    and the indices of the flares in the catalogs as coords 'goes_index' and
+    'rhessi_index'.
+    """
+    index_goes, index_rhessi, overlap = match_intervals(
+        *goes_intervals(goes), *rhessi_intervals(rhessi)
+    )
+    if max_distance is not None:
+        unit = max_distance.unit
+        dx = (
+            goes.coords["x"].to(unit=unit, dtype="float64").values[index_goes]
+            - rhessi.coords["x"].to(unit=unit, dtype="float64").values[index_rhessi]
+        )
+        dy = (
+            goes.coords["y"].to(unit=unit, dtype="float64").values[index_goes]
+            - rhessi.coords["y"].to(unit=unit, dtype="float64").values[index_rhessi]
+        )
+        close = np.hypot(dx, dy) <= max_distance.value
+        index_goes = index_goes[close]
+        index_rhessi = index_rhessi[close]
+        overlap = overlap[close]
+    return sc.DataArray(
+        sc.array(dims=["match"], values=overlap, unit="s"),
+        coords={
+            "goes_index": sc.array(dims=["match"], values=index_goes, unit=None),
+            "rhessi_index": sc.array(dims=["match"], values=index_rhessi, unit=None),
+        },
+    )
+
+
+def random_intervals(
+    rng: np.random.Generator, n: int, span: int, mean_duration: float
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Intervals with uniform starts and exponential durations for benchmarks."""
+    start = rng.integers(0, span, n)
+    return start, start + rng.exponential(mean_duration, n).astype(np.int64) + 1
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark match_intervals")
+    parser.add_argument(
+        "--size", type=int, default=1_000_000, help="Number of events per catalog"
+    )
+    parser.add_argument(
+        "--brute-force-size",
+        type=int,
+        default=20_000,
+        help="Number of events for the comparison with the brute-force implementation",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    rng = np.random.default_rng(1875)
+    # About 20 years with flares that last about half an hour.
+    span = 20 * 365 * 24 * 3600
+
+    n = args.brute_force_size
+    a = random_intervals(rng, n, span // 1000, 1800)
+    b = random_intervals(rng, n, span // 1000, 1800)
+    start = time.perf_counter()
+    expected = match_intervals_brute_force(*a, *b)
+    brute_force = time.perf_counter() - start
+    start = time.perf_counter()
+    actual = match_intervals(*a, *b)
+    sweep = time.perf_counter() - start
+    if not all(np.array_equal(x, y) for x, y in zip(expected, actual)):
+        raise RuntimeError("match_intervals disagrees with the brute-force version")
+    print(
+        f"{n} x {n} events, {len(actual[0])} matches:"
+        f" brute force {brute_force:.2f}s, match_intervals {sweep:.3f}s"
+    )
+
+    n = args.size
+    a = random_intervals(rng, n, span, 1800)
+    b = random_intervals(rng, n, span, 1800)
+    start = time.perf_counter()
+    actual = match_intervals(*a, *b)
+    print(
+        f"{n} x {n} events, {len(actual[0])} matches:"
+        f" match_intervals {time.perf_counter() - start:.2f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
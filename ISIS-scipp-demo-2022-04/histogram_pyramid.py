@@ -0,0 +1,183 @@
+"""
+Multi-resolution histograms of the RHESSI flares.
+
+The flares are histogrammed once on a fine x/y/peak_time grid.
+Coarser levels are made by repeatedly merging pairs of neighbouring bins
+along every dimension.
+Each level holds the number of flares ('counts', the sum of the data) and the
+sum of their durations ('duration') per bin.
+
+`HistogramPyramid.query` makes histograms with arbitrary edges from the
+coarsest level that is at least as fine as the requested edges.
+Its cost depends on the number of bins, not on the number of flares.
+The result is exact if the requested edges coincide with edges of the level.
+Otherwise the counts of partially covered bins are split proportionally,
+like in `sc.rebin`.
+"""
+
+from __future__ import annotations
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+import h5py
+import numpy as np
+import scipp as sc
+
+from common import read_scipp_group, write_scipp_group
+
+DIMS = ("x", "y", "peak_time")
+# Number of bins of the finest level, must be powers of two.
+DEFAULT_SHAPE = {"x": 64, "y": 64, "peak_time": 256}
+
+
+def _fine_edges(values: np.ndarray, n: int) -> np.ndarray:
+    """n bins which contain all values."""
+    if np.issubdtype(values.dtype, np.datetime64):
+        values = values.astype(np.int64)
+        lo, hi = values.min(), values.max() + 1
+        width = -(-(hi - lo) // n)
+        return lo + width * np.arange(n + 1)
+    lo, hi = values.min(), np.nextafter(values.max(), np.inf)
+    return np.linspace(lo, hi, n + 1)
+
+
+def _coarsen(level: sc.Dataset) -> sc.Dataset:
+    """Merge pairs of bins along all dims with more than one bin."""
+    dims = [dim for dim in DIMS if level.sizes[dim] > 1]
+    coords = {
+        dim: level.coords[dim][dim, ::2] if dim in dims else level.coords[dim]
+        for dim in DIMS
+    }
+    out = {}
+    for name, da in level.items():
+        values = da.values
+        for axis, dim in enumerate(DIMS):
+            if dim in dims:
+                shape = values.shape
+                values = values.reshape(
+                    *shape[:axis], shape[axis] // 2, 2, *shape[axis + 1 :]
+                ).sum(axis=axis + 1)
+        out[name] = sc.DataArray(
+            sc.array(dims=list(DIMS), values=values, unit=da.unit), coords=coords
+        )
+    return sc.Dataset(out)
+
+
+def _as_float(var: sc.Variable) -> sc.Variable:
+    """Convert datetimes to float seconds since the epoch, leave other dtypes."""
+    if var.dtype != sc.DType.datetime64:
+        return var
+    # sc.rebin does not split bins proportionally for datetime coords.
+    return sc.array(
+        dims=var.dims,
+        values=var.values.astype("datetime64[s]").astype(np.int64).astype(np.float64),
+        unit="s",
+    )
+
+
+class HistogramPyramid:
+    def __init__(self, levels: List[sc.Dataset]):
+        """Levels must be ordered from finest to coarsest."""
+        self.levels = levels
+
+    @classmethod
+    def from_events(
+        cls, da: sc.DataArray, shape: Optional[Dict[str, int]] = None
+    ) -> HistogramPyramid:
+        """
+        Build a pyramid from flares with coords
+        x, y, peak_time, start_time, and end_time.
+        """
+        shape = {**DEFAULT_SHAPE, **(shape or {})}
+        for dim, n in shape.items():
+            if n & (n - 1):
+                raise ValueError(f"Number of bins in {dim} must be a power of two")
+        edges = {}
+        index = []
+        for dim in DIMS:
+            values = da.coords[dim].values
+            dim_edges = _fine_edges(values, shape[dim])
+            if np.issubdtype(values.dtype, np.datetime64):
+                values = values.astype(np.int64)
+                edges[dim] = sc.array(
+                    dims=[dim], values=dim_edges.astype("datetime64[s]"), unit="s"
+                )
+            else:
+                edges[dim] = sc.array(
+                    dims=[dim], values=dim_edges, unit=da.coords[dim].unit
+                )
+            index.append(np.searchsorted(dim_edges, values, side="right") - 1)
+
+        n_bins = [shape[dim] for dim in DIMS]
+        flat = np.ravel_multi_index(index, n_bins)
+        duration = (da.coords["end_time"] - da.coords["start_time"]).to(
+            unit="s", dtype="float64"
+        )
+        level = {}
+        for name, weights, unit in (
+            ("counts", da.data.values, da.unit),
+            ("duration", duration.values, duration.unit),
+        ):
+            values = np.bincount(flat, weights=weights, minlength=np.prod(n_bins))
+            level[name] = sc.DataArray(
+                sc.array(dims=list(DIMS), values=values.reshape(n_bins), unit=unit),
+                coords=edges,
+            )
+
+        level = sc.Dataset(level)
+        levels = [level]
+        while any(level.sizes[dim] > 1 for dim in DIMS):
+            level = _coarsen(level)
+            levels.append(level)
+        return cls(levels)
+
+    def save(self, fname: Union[str, Path]) -> None:
+        with h5py.File(fname, "w") as f:
+            for i, level in enumerate(self.levels):
+                write_scipp_group(f.create_group(f"level_{i}"), level)
+
+    @classmethod
+    def load(cls, fname: Union[str, Path]) -> HistogramPyramid:
+        with h5py.File(fname, "r") as f:
+            return cls([read_scipp_group(f[f"level_{i}"]) for i in range(len(f))])
+
+    def level_for(self, **edges: sc.Variable) -> int:
+        """
+        Return the index of the coarsest level whose bins are not wider than
+        the narrowest of the given edges in every dimension.
+        """
+        requested = {}
+        for dim, dim_edges in edges.items():
+            dim_edges = _as_float(dim_edges)
+            requested[dim] = sc.min(dim_edges[dim, 1:] - dim_edges[dim, :-1])
+        best = 0
+        for i, level in enumerate(self.levels):
+            for dim, width in requested.items():
+                level_edges = _as_float(level.coords[dim])
+                level_width = level_edges[dim, 1] - level_edges[dim, 0]
+                if level_width > width.to(unit=level_width.unit):
+                    return best
+            best = i
+        return best
+
+    def query(self, quantity: str = "counts", **edges: sc.Variable) -> sc.DataArray:
+        """
+        Histogram with the given edges.
+
+        Dims of the pyramid without edges are summed over.
+        For example, `query(x=x_edges, y=y_edges)` gives a 2d histogram of
+        counts and `query("duration", peak_time=time_edges)` the total duration
+        of flares in each time bin.
+        """
+        level = self.levels[self.level_for(**edges)]
+        hist = level[quantity]
+        for dim in DIMS:
+            if dim not in edges:
+                hist = hist.sum(dim)
+        for dim, dim_edges in edges.items():
+            hist.coords[dim] = _as_float(hist.coords[dim])
+            hist = sc.rebin(
+                hist, dim, _as_float(dim_edges).to(unit=hist.coords[dim].unit)
+            )
+            hist.coords[dim] = dim_edges
+        return hist
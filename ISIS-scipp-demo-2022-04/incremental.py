@@ -0,0 +1,160 @@
+"""
+Write data arrays to HDF5 files that can be extended in place.
+
+Files are written with scipp's `to_hdf5` and can be read with
+`sc.io.open_hdf5` as usual.
+But all datasets along the appended dimension, values and variances,
+are chunked and resizable so that new rows can be appended without rewriting
+the existing ones.
+Arbitrary metadata, e.g., which inputs a file was made from,
+is stored in the attributes of the root group.
+"""
+
+from __future__ import annotations
+import io
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional, Tuple, Union
+
+import h5py
+import numpy as np
+import scipp as sc
+
+# Number of rows per chunk along the appended dimension.
+CHUNK_ROWS = 1 << 14
+
+
+def _datasets(f: h5py.File, dim: str) -> Iterator[Tuple[h5py.Dataset, str, str, str]]:
+    """
+    Yield (dataset, section, name, field) for all variables which depend on dim.
+
+    section is 'data', 'coords', 'attrs', or 'masks' and name is the key of
+    the variable in that section (None for data).
+    field is 'values' or 'variances', variables with variances yield both.
+    Variables stored as nested groups (e.g., data arrays in attrs) are skipped.
+    """
+    groups = [(f["data"], "data", None)]
+    for section in ("coords", "attrs", "masks"):
+        groups.extend(
+            (group, section, group.attrs["name"]) for group in f[section].values()
+        )
+    for group, section, name in groups:
+        values = group.get("values")
+        if isinstance(values, h5py.Dataset) and dim in list(values.attrs["dims"]):
+            if list(values.attrs["dims"]).index(dim) != 0:
+                raise ValueError(f"{dim} must be the outer dimension of {name}")
+            yield values, section, name, "values"
+            if "variances" in group:
+                yield group["variances"], section, name, "variances"
+
+
+def _variable(da: sc.DataArray, section: str, name: str) -> sc.Variable:
+    return da.data if section == "data" else getattr(da, section)[name]
+
+
+def _raw_values(var: sc.Variable, field: str = "values") -> np.ndarray:
+    """Return values or variances in the representation of scipp's HDF5 files."""
+    if field == "variances":
+        return var.variances
+    if var.dtype == sc.DType.datetime64:
+        return var.values.view(np.int64)
+    if var.dtype == sc.DType.string:
+        return np.asarray(var.values, dtype=object)
+    return var.values
+
+
+def save_appendable(
+    da: sc.DataArray,
+    fname: Union[str, Path],
+    dim: str,
+    compression: Optional[str] = None,
+    **metadata: Any,
+) -> None:
+    """
+    Write da to fname such that `append` can extend it along dim.
+
+    compression is passed to h5py for all datasets along dim, e.g., 'gzip'.
+    With compression, the bytes are also shuffled, which makes numeric columns
+    compress much better. Appended rows use the same filters.
+    """
+    # Write into memory first and copy into the file, replacing datasets in
+    # place would leave the space of the unchunked ones unused in the file.
+    buffer = io.BytesIO()
+    da.save_hdf5(buffer)
+    with h5py.File(buffer, "r") as src, h5py.File(fname, "w") as f:
+        appendable = {dataset.name for dataset, *_ in _datasets(src, dim)}
+
+        def copy(path: str, obj) -> None:
+            if isinstance(obj, h5py.Group):
+                f.require_group(path).attrs.update(obj.attrs)
+            elif obj.name in appendable:
+                values = obj[()]
+                new = f.create_dataset(
+                    path,
+                    data=values,
+                    dtype=obj.dtype,
+                    chunks=(CHUNK_ROWS, *values.shape[1:]),
+                    maxshape=(None, *values.shape[1:]),
+                    compression=compression,
+                    shuffle=compression is not None,
+                )
+                new.attrs.update(obj.attrs)
+            else:
+                src.copy(obj, f, path)
+
+        f.attrs.update(src.attrs)
+        src.visititems(copy)
+        f.attrs.update(metadata)
+
+
+def append(
+    da: sc.DataArray, fname: Union[str, Path], dim: str, **metadata: Any
+) -> None:
+    """
+    Append the rows of da to a file written by save_appendable.
+
+    da must have the same variables along dim with the same dtypes, inner
+    shapes, and presence of variances as the data array in the file;
+    units are not checked.
+    Variables that do not depend on dim are left untouched.
+    The metadata replaces the stored metadata with the same names.
+    """
+    n_new = da.sizes[dim]
+    with h5py.File(fname, "r+") as f:
+        datasets = list(_datasets(f, dim))
+        for dataset, section, name, field in datasets:
+            if dataset.maxshape[0] is not None:
+                raise ValueError(f"{fname} was not written by save_appendable")
+            var = _variable(da, section, name)
+            if (var.variances is not None) != ("variances" in dataset.parent):
+                raise sc.VariancesError(
+                    f"Cannot append {section} {name} with variances"
+                    if var.variances is not None
+                    else f"Cannot append {section} {name} without variances"
+                )
+            if field == "variances":
+                continue
+            if var.dims[0] != dim or var.shape[1:] != dataset.shape[1:]:
+                raise sc.DimensionError(
+                    f"Cannot append {section} {name} with dims {var.dims}"
+                )
+            if str(var.dtype) != dataset.attrs["dtype"]:
+                raise sc.DTypeError(f"Cannot append {section} {name} of {var.dtype}")
+        # Only write after all checks have passed to not leave a broken file.
+        for dataset, section, name, field in datasets:
+            values = _raw_values(_variable(da, section, name), field)
+            n_old = dataset.shape[0]
+            dataset.resize(n_old + n_new, axis=0)
+            dataset[n_old:] = values
+            if field == "values":
+                dataset.attrs["shape"] = np.array(dataset.shape)
+        f.attrs.update(metadata)
+
+
+def read_metadata(fname: Union[str, Path]) -> Dict[str, Any]:
+    """Return the metadata stored by save_appendable or append."""
+    with h5py.File(fname, "r") as f:
+        return {
+            key: val
+            for key, val in f.attrs.items()
+            if key not in ("name", "scipp-type", "scipp-version")
+        }
@@ -0,0 +1,113 @@
+"""
+Cache for parsed columns of the flare lists.
+
+Entries are keyed on the hash of the input file and the version of the parser.
+Each entry is a directory with one .npy file per column which can be
+memory-mapped when loading.
+The least recently used entries are removed when the cache grows too large.
+
+Run this file to list or clear the cache:
+    python parse_cache.py list
+    python parse_cache.py clear
+"""
+
+from __future__ import annotations
+import argparse
+import json
+import os
+from pathlib import Path
+import shutil
+from typing import Dict, Optional
+
+import numpy as np
+
+CACHE_DIR = Path(__file__).parent / "data" / "parse_cache"
+DEFAULT_MAX_SIZE = 1 << 30
+
+
+def cache_key(parser: str, version: int, file_hash: str) -> str:
+    """Build a key from a pooch hash like 'md5:abc...'."""
+    return f"{parser}-v{version}-{file_hash.replace(':', '-')}"
+
+
+class ParseCache:
+    def __init__(self, path: Path = CACHE_DIR, max_size: int = DEFAULT_MAX_SIZE):
+        self.path = Path(path)
+        self.max_size = max_size
+
+    def get(self, key: str) -> Optional[Dict[str, np.ndarray]]:
+        entry = self.path / key
+        try:
+            names = json.loads((entry / "columns.json").read_text())
+        except FileNotFoundError:
+            return None
+        # Mark as recently used.
+        os.utime(entry)
+        return {
+            name: np.load(entry / f"{name}.npy", mmap_mode="r") for name in names
+        }
+
+    def put(self, key: str, columns: Dict[str, np.ndarray]) -> None:
+        entry = self.path / key
+        tmp = self.path / f".{key}.{os.getpid()}"
+        tmp.mkdir(parents=True, exist_ok=True)
+        for name, column in columns.items():
+            column = np.asarray(column)
+            # Drop dtype metadata which np.save does not support.
+            # (Pickling datetime64 arrays adds empty metadata in some numpy versions.)
+            column = column.view(np.dtype(column.dtype.str))
+            np.save(tmp / f"{name}.npy", column, allow_pickle=False)
+        # Written last, entries without it are incomplete.
+        (tmp / "columns.json").write_text(json.dumps(list(columns)))
+        try:
+            tmp.rename(entry)
+        except OSError:
+            # Another process stored the same entry in the meantime.
+            shutil.rmtree(tmp)
+        self.evict()
+
+    def entries(self) -> Dict[str, int]:
+        """Return the size in bytes of every entry, least recently used first."""
+        if not self.path.exists():
+            return {}
+        entries = sorted(
+            (p for p in self.path.iterdir() if not p.name.startswith(".")),
+            key=lambda p: p.stat().st_mtime,
+        )
+        return {
+            p.name: sum(f.stat().st_size for f in p.iterdir()) for p in entries
+        }
+
+    def evict(self) -> None:
+        entries = self.entries()
+        size = sum(entries.values())
+        for key, entry_size in entries.items():
+            if size <= self.max_size:
+                break
+            self.invalidate(key)
+            size -= entry_size
+
+    def invalidate(self, key: Optional[str] = None) -> None:
+        """Remove one entry or, if key is None, the whole cache."""
+        shutil.rmtree(self.path if key is None else self.path / key, ignore_errors=True)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Manage the parse cache")
+    parser.add_argument("command", choices=("list", "clear"))
+    parser.add_argument("--path", type=Path, default=CACHE_DIR)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    cache = ParseCache(args.path)
+    if args.command == "clear":
+        cache.invalidate()
+    else:
+        for key, size in cache.entries().items():
+            print(f"{size / 1e6:10.1f} MB  {key}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,26 +3,63 @@ Convert GOES's xray flare event list to a scipp HDF5 file.
 
 Downloads the event list if necessary.
 Output is written to data/goes_flares.h5
+With --incremental, only files that are not yet in the output are parsed
+and appended to it.
+The output contains a time index for time_index.load_range.
+With --compact, the output uses less space, see make_compact.
+With --column-store, the output is also exported to data/goes_flares/
+for column_store.load_columns.
+With --profile / --profile-json, the time and memory used by each stage are
+printed / written to a file, see profiling.py.
 """
 
 from __future__ import annotations
+import argparse
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
+from contextlib import nullcontext
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 import numpy as np
 import pooch
 import scipp as sc
 
-from common import parse_datetimes
+from column_store import export_columns
+from common import (
+    check_round_trip,
+    compact_ones,
+    first_blank_line,
+    parse_datetimes,
+    parse_datetimes_batch,
+    parse_digits,
+    token_column,
+    tokenize,
+)
+from incremental import append, read_metadata, save_appendable
+from parse_cache import DEFAULT_MAX_SIZE, ParseCache, cache_key
+import profiling
+from time_index import load_range, update_time_index
 
 DATA_DIR = Path(__file__).parent / "data"
+COLUMN_STORE_DIR = DATA_DIR / "goes_flares"
+# Increment when the output of load_columns changes to invalidate the parse cache.
+PARSER_VERSION = 2
+# Stored as 'compact' in the metadata of compact output files, 0 otherwise.
+# Increment when make_compact changes so that --incremental rewrites old files.
+COMPACT_LAYOUT = 2
+BASE_URL = "https://hesperia.gsfc.nasa.gov/goes/goes_event_listings/"
 
 
-def flare_list_files():
-    registry = pooch.create(
+def flare_list_registry(base_url: str = BASE_URL) -> pooch.Pooch:
+    return pooch.create(
         path=DATA_DIR / "pooch",
-        base_url="https://hesperia.gsfc.nasa.gov/goes/goes_event_listings/",
+        base_url=base_url,
         registry={
             "goes_xray_event_list_1975.txt": "md5:3b86a114ff8b89f022099e48a45490f1",
             "goes_xray_event_list_1976.txt": "md5:686996b33fa10843349511534cede792",
@@ -73,9 +110,32 @@ def flare_list_files():
             "goes_xray_event_list_2021.txt": "md5:4fe373bc7896457f300955d687c107a7",
         },
     )
+
+
+def flare_list_files(base_url: str = BASE_URL):
+    registry = flare_list_registry(base_url)
     return [registry.fetch(name) for name in registry.registry]
 
 
+def fetch_flare_list_files(
+    jobs: int, base_url: str = BASE_URL
+) -> Iterator[Tuple[int, str]]:
+    """
+    Download the files concurrently using up to `jobs` threads.
+
+    Yields (index in registry, file name) as soon as a file has been downloaded
+    and its hash verified by pooch. So the order is not the registry order.
+    """
+    registry = flare_list_registry(base_url)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {
+            pool.submit(registry.fetch, name): index
+            for index, name in enumerate(registry.registry)
+        }
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
 def parse_position(s) -> Tuple[float, float]:
     y_sign = +1 if s[0] == "N" else -1
     x_sign = +1 if s[3] == "E" else -1
@@ -87,6 +147,8 @@ def parse_position(s) -> Tuple[float, float]:
 @dataclass
 class Entry:
     peak_time: np.datetime64
+    start_time: np.datetime64
+    end_time: np.datetime64
     duration: int
     class_: str
     x: float
@@ -103,6 +165,8 @@ class Entry:
 
         return cls(
             peak_time=times["peak_time"],
+            start_time=times["start_time"],
+            end_time=times["end_time"],
             duration=times["duration"],
             class_=fields[4],
             x=pos[0],
@@ -111,8 +175,128 @@ class Entry:
         )
 
 
+def make_data_array(
+    peak_time, start_time, end_time, duration, class_, x, y, region
+) -> sc.DataArray:
+    return sc.DataArray(
+        sc.ones(sizes={"event": len(peak_time)}, unit="count"),
+        coords={
+            "time": sc.array(dims=["event"], values=peak_time, unit="s"),
+            "start_time": sc.array(dims=["event"], values=start_time, unit="s"),
+            "end_time": sc.array(dims=["event"], values=end_time, unit="s"),
+            "duration": sc.array(dims=["event"], values=duration, unit="s"),
+            "x": sc.array(dims=["event"], values=x, unit="asec"),
+            "y": sc.array(dims=["event"], values=y, unit="asec"),
+        },
+        attrs={
+            "class": sc.array(dims=["event"], values=class_),
+            "region": sc.array(dims=["event"], values=region),
+        },
+    )
+
+
+CLASS_LETTERS = ("A", "B", "C", "M", "X")
+
+
+def encode_class(class_: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Split classes like 'M1.2' into the index of the letter in CLASS_LETTERS
+    and the magnitude.
+    """
+    class_ = np.asarray(class_, dtype=str)
+    letters = np.array(CLASS_LETTERS)
+    first = class_.astype("U1")
+    code = np.searchsorted(letters, first)
+    if np.any(letters[np.minimum(code, len(letters) - 1)] != first):
+        raise ValueError("Unknown GOES class letter")
+    magnitude = np.char.lstrip(class_, "".join(CLASS_LETTERS)).astype(np.float32)
+    return code.astype(np.int32), magnitude
+
+
+def decode_class(code: np.ndarray, magnitude: np.ndarray) -> np.ndarray:
+    """
+    Inverse of encode_class up to formatting.
+
+    Magnitudes are written with at least one decimal, e.g., 'X10' becomes 'X10.0'.
+    """
+    unique, inverse = np.unique(magnitude, return_inverse=True)
+    digits = np.array([np.format_float_positional(m, trim="0") for m in unique])
+    return np.char.add(np.array(CLASS_LETTERS)[code], digits[inverse.reshape(-1)])
+
+
+def make_compact(da: sc.DataArray) -> sc.DataArray:
+    """
+    Convert the output of make_data_array to use less memory and disk space.
+
+    The class is split into 'class_letter' (index into CLASS_LETTERS) and
+    'class_magnitude', region is narrowed to int32, positions are stored
+    as float32, and the data is a broadcast scalar.
+    'duration' is dropped because it equals end_time - start_time.
+    Use expand_compact to get back to the default layout.
+    """
+    code, magnitude = encode_class(da.attrs["class"].values)
+    dims = da.dims
+    return sc.DataArray(
+        compact_ones(da.sizes, da.unit),
+        coords={
+            "time": da.coords["time"],
+            "start_time": da.coords["start_time"],
+            "end_time": da.coords["end_time"],
+            "x": da.coords["x"].astype("float32"),
+            "y": da.coords["y"].astype("float32"),
+        },
+        attrs={
+            "class_letter": sc.array(dims=dims, values=code, unit=None),
+            "class_magnitude": sc.array(dims=dims, values=magnitude),
+            "region": da.attrs["region"].astype("int32"),
+        },
+    )
+
+
+def expand_compact(da: sc.DataArray) -> sc.DataArray:
+    """Convert the output of make_compact back to the layout of make_data_array."""
+    return sc.DataArray(
+        da.data.astype("float64"),
+        coords={
+            "time": da.coords["time"],
+            "start_time": da.coords["start_time"],
+            "end_time": da.coords["end_time"],
+            "duration": (da.coords["end_time"] - da.coords["start_time"]).to(
+                unit="s", dtype="int64"
+            ),
+            "x": da.coords["x"].astype("float64"),
+            "y": da.coords["y"].astype("float64"),
+        },
+        attrs={
+            "class": sc.array(
+                dims=da.dims,
+                values=decode_class(
+                    da.attrs["class_letter"].values, da.attrs["class_magnitude"].values
+                ),
+            ),
+            "region": da.attrs["region"].astype("int64"),
+        },
+    )
+
+
+def to_compact(da: sc.DataArray) -> sc.DataArray:
+    """make_compact with a check that no information is lost."""
+    compact = make_compact(da)
+    expanded = expand_compact(compact)
+    check_round_trip(da, expanded, skip=("class",))
+    # The formatting of classes may change, compare their encoded values instead.
+    original = encode_class(da.attrs["class"].values)
+    restored = encode_class(expanded.attrs["class"].values)
+    if not all(np.array_equal(a, b) for a, b in zip(original, restored)):
+        raise ValueError("Round trip changed the values of attr 'class'")
+    return compact
+
+
 def load_txt_file(fname):
+    """Parse a file line by line. See load_txt_file_columnar for a faster version."""
     peak_time = []
+    start_time = []
+    end_time = []
     duration = []
     class_ = []
     x_pos = []
@@ -127,31 +311,302 @@ def load_txt_file(fname):
             if (entry := Entry.parse(line)) is None:
                 continue
             peak_time.append(entry.peak_time)
+            start_time.append(entry.start_time)
+            end_time.append(entry.end_time)
             duration.append(entry.duration)
             class_.append(entry.class_)
             x_pos.append(entry.x)
             y_pos.append(entry.y)
             region.append(entry.region)
 
-    return sc.DataArray(
-        sc.ones(sizes={"event": len(peak_time)}, unit="count"),
-        coords={
-            "time": sc.array(dims=["event"], values=peak_time, unit="s"),
-            "duration": sc.array(dims=["event"], values=duration, unit="s"),
-            "x": sc.array(dims=["event"], values=x_pos, unit="asec"),
-            "y": sc.array(dims=["event"], values=y_pos, unit="asec"),
-        },
-        attrs={
-            "class": sc.array(dims=["event"], values=class_),
-            "region": sc.array(dims=["event"], values=region),
-        },
+    return make_data_array(
+        peak_time, start_time, end_time, duration, class_, x_pos, y_pos, region
     )
 
 
+def read_fields(fname) -> List[np.ndarray]:
+    """
+    Split a file into columns of byte strings with one element per entry.
+
+    Like load_txt_file, this stops at the first blank line and skips lines
+    that do not have exactly 7 fields.
+    The file is tokenized as a whole using numpy, there is no loop over lines.
+    """
+    with open(fname, "rb") as f:
+        for _ in range(6):
+            f.readline()
+        buffer = np.frombuffer(f.read(), dtype=np.uint8)
+
+    token_starts, token_ends, tokens_per_line = tokenize(buffer)
+    keep_line = tokens_per_line == 7
+    keep_line[first_blank_line(tokens_per_line) :] = False
+    keep = np.repeat(keep_line, tokens_per_line)
+    token_starts = token_starts[keep].reshape(-1, 7)
+    token_ends = token_ends[keep].reshape(-1, 7)
+    return [
+        token_column(buffer, starts, ends)
+        for starts, ends in zip(token_starts.T, token_ends.T)
+    ]
+
+
+def parse_position_array(s: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Vectorized version of parse_position."""
+    chars = np.asarray(s).astype("S6").view(np.uint8).reshape(len(s), 6)
+    y_sign = np.where(chars[:, 0] == ord("N"), 1.0, -1.0)
+    x_sign = np.where(chars[:, 3] == ord("E"), 1.0, -1.0)
+    y = y_sign * parse_digits(chars, 1, 3)
+    x = x_sign * parse_digits(chars, 4, 6)
+    return x, y
+
+
+def load_columns(fname) -> Dict[str, np.ndarray]:
+    """Parse a whole file into numpy arrays, one per column."""
+    date, start, peak, end, class_, position, region = read_fields(fname)
+    times = parse_datetimes_batch(date, start, peak, end)
+    x, y = parse_position_array(position)
+    return {
+        "peak_time": times["peak_time"],
+        "start_time": times["start_time"],
+        "end_time": times["end_time"],
+        "duration": times["duration"],
+        "class_": class_.astype(str),
+        "x": x,
+        "y": y,
+        "region": region.astype(np.int64),
+    }
+
+
+def load_txt_file_columnar(fname):
+    return make_data_array(**load_columns(fname))
+
+
+def file_hash(fname) -> str:
+    """Return the hash of a file as listed in the registry or compute it."""
+    registry = flare_list_registry().registry
+    name = Path(fname).name
+    if name in registry:
+        return registry[name]
+    return "md5:" + pooch.file_hash(fname, alg="md5")
+
+
+def load_txt_files(
+    fnames: Iterable, jobs: int = 1, cache: Optional[ParseCache] = None
+) -> sc.DataArray:
+    """
+    Parse multiple files, concatenate them in the given order, and sort by time.
+
+    The sort is stable, events with the same peak time stay in file order.
+    With jobs > 1, the files are parsed in a process pool.
+    The workers only return numpy columns and the result does not depend on
+    the number of workers.
+    If a cache is given, files that have been parsed before are loaded from it.
+    """
+    return load_indexed_txt_files(enumerate(fnames), jobs=jobs, cache=cache)
+
+
+def load_indexed_txt_files(
+    indexed_fnames: Iterable[Tuple[int, str]],
+    jobs: int = 1,
+    cache: Optional[ParseCache] = None,
+) -> sc.DataArray:
+    """
+    Like load_txt_files but files can arrive in any order.
+
+    Parsing of each file starts as soon as it is produced by `indexed_fnames`
+    and the results are concatenated in the order of the indices.
+    """
+    columns = {}
+    missed = {}
+    with ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else nullcontext() as pool:
+        for index, fname in indexed_fnames:
+            if cache is not None:
+                key = cache_key("goes", PARSER_VERSION, file_hash(fname))
+                if (cached := cache.get(key)) is not None:
+                    columns[index] = cached
+                    continue
+                missed[index] = key
+            if pool is None:
+                columns[index] = load_columns(fname)
+            else:
+                columns[index] = pool.submit(load_columns, fname)
+        for index, column in columns.items():
+            if isinstance(column, Future):
+                columns[index] = column.result()
+            if index in missed:
+                cache.put(missed[index], columns[index])
+
+    columns = [columns[index] for index in sorted(columns)]
+    columns = {key: np.concatenate([c[key] for c in columns]) for key in columns[0]}
+    # The files are ordered by start time, overlapping flares are not ordered
+    # by peak time. But the time index requires sorted peak times.
+    order = np.argsort(columns["peak_time"], kind="stable")
+    return make_data_array(**{key: val[order] for key, val in columns.items()})
+
+
+def last_time(da: sc.DataArray) -> int:
+    """The latest peak time in seconds, stored for update_output."""
+    return int(
+        da.coords["time"].values.view(np.int64).max(initial=np.iinfo(np.int64).min)
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of processes for parsing the yearly files in parallel",
+    )
+    parser.add_argument(
+        "--fetch-jobs",
+        type=int,
+        default=1,
+        help="Number of threads for downloading the yearly files concurrently",
+    )
+    parser.add_argument(
+        "--base-url", default=BASE_URL, help="URL to download the event lists from"
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="Do not use the parse cache"
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Write smaller dtypes and an encoded class, see make_compact",
+    )
+    parser.add_argument(
+        "--column-store",
+        action="store_true",
+        help="Also export the output to data/goes_flares/, see column_store.py",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Append new yearly files to an existing output file instead of rewriting it",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=DEFAULT_MAX_SIZE,
+        help="Maximum size of the parse cache in bytes",
+    )
+    profiling.add_arguments(parser)
+    return parser.parse_args()
+
+
+def update_output(
+    fname: Path,
+    jobs: int,
+    cache: Optional[ParseCache],
+    base_url: str,
+    compact: bool,
+) -> bool:
+    """
+    Append the files that are not yet in fname.
+
+    The hashes of the files in an output file are stored in its metadata.
+    Returns False if the output cannot be updated because files other than
+    the last ones in the registry were added or changed, because the
+    output was written in a different mode, or because new events are older
+    than the stored ones such that the output would not be sorted by time.
+    The file is not modified in that case.
+    """
+    registry = flare_list_registry(base_url)
+    hashes = list(registry.registry.values())
+    metadata = read_metadata(fname)
+    stored = list(metadata.get("source_hashes", []))
+    if not stored or hashes[: len(stored)] != stored:
+        return False
+    if int(metadata.get("compact", 0)) != (COMPACT_LAYOUT if compact else 0):
+        return False
+    if "last_time" not in metadata:
+        return False
+    new = list(registry.registry)[len(stored) :]
+    if new:
+        print(f"appending {len(new)} file(s) to {fname}")
+        with profiling.stage("download"):
+            files = [registry.fetch(name) for name in new]
+        with profiling.stage("parse") as s:
+            da = load_txt_files(files, jobs, cache)
+            s.set(rows_out=da.sizes["event"])
+        stored_last_time = int(metadata["last_time"])
+        if np.any(da.coords["time"].values.view(np.int64) < stored_last_time):
+            print("new events are older than the stored ones")
+            return False
+        new_last_time = max(stored_last_time, last_time(da))
+        if compact:
+            with profiling.stage("compact"):
+                da = to_compact(da)
+        with profiling.stage("append", rows_in=da.sizes["event"]) as s:
+            size = fname.stat().st_size
+            append(da, fname, "event", source_hashes=hashes, last_time=new_last_time)
+            s.set(rows_out=da.sizes["event"], bytes_written=fname.stat().st_size - size)
+        with profiling.stage("time_index"):
+            update_time_index(fname, "time")
+    return True
+
+
 def main():
-    data = [load_txt_file(fname) for fname in flare_list_files()]
-    full = sc.concat(data, dim="event")
-    full.to_hdf5(DATA_DIR / "goes_flares.h5")
+    args = parse_args()
+    if args.profile or args.profile_json:
+        profiling.enable()
+    try:
+        run(args)
+    finally:
+        profiling.finish("prepare_exercise_data_goes", args.profile, args.profile_json)
+
+
+def run(args):
+    cache = None if args.no_cache else ParseCache(max_size=args.cache_size)
+    out = DATA_DIR / "goes_flares.h5"
+    if args.incremental and out.exists():
+        with profiling.stage("update"):
+            updated = update_output(out, args.jobs, cache, args.base_url, args.compact)
+        if updated:
+            if args.column_store:
+                # Only the new files have been loaded, export the whole file.
+                with profiling.stage("column_store") as s:
+                    export_columns(load_range(out), COLUMN_STORE_DIR)
+                    s.set(written=COLUMN_STORE_DIR)
+            return
+        print(f"cannot append to {out}, rewriting it")
+    if args.fetch_jobs > 1:
+        # Downloading and parsing overlap.
+        with profiling.stage("download_and_parse") as s:
+            full = load_indexed_txt_files(
+                fetch_flare_list_files(args.fetch_jobs, base_url=args.base_url),
+                jobs=args.jobs,
+                cache=cache,
+            )
+            s.set(rows_out=full.sizes["event"])
+    else:
+        with profiling.stage("download"):
+            files = flare_list_files(base_url=args.base_url)
+        with profiling.stage("parse") as s:
+            full = load_txt_files(files, jobs=args.jobs, cache=cache)
+            s.set(rows_out=full.sizes["event"])
+    if args.compact:
+        with profiling.stage("compact"):
+            full = to_compact(full)
+    with profiling.stage("to_hdf5", rows_in=full.sizes["event"]) as s:
+        save_appendable(
+            full,
+            out,
+            "event",
+            compression="gzip" if args.compact else None,
+            source_hashes=list(flare_list_registry(args.base_url).registry.values()),
+            compact=COMPACT_LAYOUT if args.compact else 0,
+            last_time=last_time(full),
+        )
+        s.set(rows_out=full.sizes["event"], written=out)
+    with profiling.stage("time_index"):
+        update_time_index(out, "time")
+    if args.column_store:
+        with profiling.stage("column_store") as s:
+            export_columns(full, COLUMN_STORE_DIR)
+            s.set(written=COLUMN_STORE_DIR)
 
 
 if __name__ == "__main__":
@@ -3,34 +3,66 @@ Convert RHESSI's xray flare event list to a scipp HDF5 file.
 
 Downloads the event list if necessary.
 Output is written to data/hessi_flares.h5
+With --incremental, only flares that are not yet in the output are parsed
+and appended to it.
+The output contains a time index for time_index.load_range.
+With --compact, the output uses less space, see make_compact.
+With --column-store, the output is also exported to data/rhessi_flares/
+for column_store.load_columns.
+With --pyramid, histograms for histogram_pyramid.HistogramPyramid are written
+to data/rhessi_pyramid.h5
+With --profile / --profile-json, the time and memory used by each stage are
+printed / written to a file, see profiling.py.
 """
 
 from __future__ import annotations
+import argparse
 from pathlib import Path
 import re
+from typing import Dict, Iterable, Iterator, Optional, Tuple
 
 import numpy as np
 import pooch
 import scipp as sc
 
-from common import parse_datetimes
+from column_store import export_columns
+from common import (
+    check_round_trip,
+    compact_ones,
+    first_blank_line,
+    parse_datetimes,
+    parse_datetimes_batch,
+    token_column,
+    tokenize,
+)
+from histogram_pyramid import HistogramPyramid
+from incremental import append, read_metadata, save_appendable
+from parse_cache import DEFAULT_MAX_SIZE, ParseCache, cache_key
+import profiling
+from time_index import load_range, update_time_index
 
 DATA_DIR = Path(__file__).parent / "data"
+COLUMN_STORE_DIR = DATA_DIR / "rhessi_flares"
+FLARE_LIST_HASH = "md5:89392347dbd0d954e21fe06c9c54c0dd"
+# Increment when the output of parse_flare_list changes to invalidate the parse cache.
+PARSER_VERSION = 2
 
 
-def flare_list_file():
+def flare_list_file(mode="r"):
     registry = pooch.create(
         path=DATA_DIR / "pooch",
         base_url="https://hesperia.gsfc.nasa.gov/hessidata/dbase/",
-        registry={"hessi_flare_list.txt": "md5:89392347dbd0d954e21fe06c9c54c0dd"},
+        registry={"hessi_flare_list.txt": FLARE_LIST_HASH},
     )
-    return open(registry.fetch("hessi_flare_list.txt"), "r")
+    return open(registry.fetch("hessi_flare_list.txt"), mode)
+
+
+QUALITY_PATTERN = re.compile(r"Q(\d)")
 
 
 def get_quality(flags: list) -> int:
-    pattern = re.compile(r"Q(\d)")
     for flag in flags:
-        if match := pattern.match(flag):
+        if match := QUALITY_PATTERN.match(flag):
             return int(match[1])
     return -1
 
@@ -62,6 +94,46 @@ FLAGS = (
     "SE",
     "SS",
 )
+ECLIPSED_FLAGS = ("ED", "EE", "ES")
+
+# With packed flags, all of FLAGS are stored in a single int32 attr 'flags'
+# where bit i (counting from the least significant bit) is set if the flare
+# has flag FLAGS[i]. E.g. 'a0' is bit 0, 'ED' bit 7, 'NS' bit 17, and 'SS' bit 24.
+# 'eclipsed' and 'non_solar' are not stored as they can be computed from 'flags'.
+
+
+def flag_mask(names: Iterable[str]) -> int:
+    """Return an integer with the bits of all given flags set."""
+    mask = 0
+    for name in names:
+        mask |= 1 << FLAGS.index(name)
+    return mask
+
+
+def any_flag(flags: sc.Variable, *names: str) -> sc.Variable:
+    """Return True for every flare that has at least one of the given flags."""
+    return sc.array(
+        dims=flags.dims, values=(flags.values & np.int32(flag_mask(names))) != 0
+    )
+
+
+def all_flags(flags: sc.Variable, *names: str) -> sc.Variable:
+    """Return True for every flare that has all of the given flags."""
+    mask = np.int32(flag_mask(names))
+    return sc.array(dims=flags.dims, values=(flags.values & mask) == mask)
+
+
+def pack_flags(attrs: Dict[str, sc.Variable]) -> sc.Variable:
+    """Combine boolean attrs named like FLAGS into a packed bitmask."""
+    flags = np.zeros(attrs[FLAGS[0]].shape, dtype=np.int32)
+    for i, name in enumerate(FLAGS):
+        flags |= attrs[name].values.astype(np.int32) << np.int32(i)
+    return sc.array(dims=attrs[FLAGS[0]].dims, values=flags, unit=None)
+
+
+def unpack_flags(flags: sc.Variable) -> Dict[str, sc.Variable]:
+    """Split a packed bitmask into one boolean variable per flag."""
+    return {name: any_flag(flags, name) for name in FLAGS}
 
 
 def parse_line(line):
@@ -109,6 +181,10 @@ def load_txt_file():
             for key, val in entry.items():
                 values.setdefault(key, []).append(val)
 
+    return make_data_array(values)
+
+
+def make_data_array(values: dict) -> sc.DataArray:
     energy_range = sc.array(
         dims=["flare", "energy"], values=values.pop("energy_range"), unit="keV"
     )
@@ -144,43 +220,310 @@ def load_txt_file():
     )
 
 
+class ColumnBuffer:
+    """Numpy array that can be appended to, similar to a list."""
+
+    def __init__(self, dtype, inner_shape: Tuple[int, ...] = (), capacity=1 << 16):
+        self._data = np.empty((capacity, *inner_shape), dtype=dtype)
+        self._size = 0
+
+    def extend(self, values: np.ndarray) -> None:
+        new_size = self._size + len(values)
+        if new_size > len(self._data):
+            capacity = max(new_size, 2 * len(self._data))
+            data = np.empty((capacity, *self._data.shape[1:]), dtype=self._data.dtype)
+            data[: self._size] = self._data[: self._size]
+            self._data = data
+        self._data[self._size : new_size] = values
+        self._size = new_size
+
+    @property
+    def values(self) -> np.ndarray:
+        return self._data[: self._size]
+
+
+def read_line_chunks(f, chunk_size: int) -> Iterator[np.ndarray]:
+    """Read a binary file in chunks of about chunk_size bytes of complete lines."""
+    rest = b""
+    while data := f.read(chunk_size):
+        data = rest + data
+        end = data.rfind(b"\n") + 1
+        rest = data[end:]
+        if end:
+            yield np.frombuffer(data[:end], dtype=np.uint8)
+    if rest:
+        yield np.frombuffer(rest, dtype=np.uint8)
+
+
+def _classify_flag_tokens(tokens: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the bit in FLAGS and the quality encoded in each flag token."""
+    unique, inverse = np.unique(tokens, return_inverse=True)
+    bits = np.zeros(len(unique), dtype=np.int32)
+    quality = np.full(len(unique), -1, dtype=np.int64)
+    for i, token in enumerate(unique.astype(str)):
+        if token in FLAGS:
+            bits[i] = 1 << FLAGS.index(token)
+        if match := QUALITY_PATTERN.match(token):
+            quality[i] = int(match[1])
+    return bits[inverse], quality[inverse]
+
+
+def parse_chunk(buffer: np.ndarray) -> Tuple[Dict[str, np.ndarray], bool, int]:
+    """
+    Parse complete lines into columns.
+
+    Flags are returned as a bitmask with bit i corresponding to FLAGS[i].
+    The second return value is True if the chunk contains the end of the table,
+    that is, a blank line.
+    The third is the number of bytes of the table in the chunk, i.e., the
+    offset of the blank line or the size of the chunk.
+    """
+    token_starts, token_ends, tokens_per_line = tokenize(buffer)
+    if len(buffer) and buffer[-1] == ord("\n"):
+        # Nothing after the last newline, this is not a line.
+        tokens_per_line = tokens_per_line[:-1]
+    n_lines = first_blank_line(tokens_per_line)
+    done = n_lines < len(tokens_per_line)
+    table_bytes = len(buffer)
+    if done:
+        line_ends = np.flatnonzero(buffer == ord("\n"))
+        table_bytes = int(line_ends[n_lines - 1]) + 1 if n_lines else 0
+    tokens_per_line = tokens_per_line[:n_lines]
+    if np.any(tokens_per_line < 12):
+        raise ValueError("Expected at least 12 fields in each line")
+
+    line_offsets = np.cumsum(tokens_per_line) - tokens_per_line
+
+    def column(i):
+        index = line_offsets + i
+        return token_column(buffer, token_starts[index], token_ends[index])
+
+    times = parse_datetimes_batch(column(1), column(2), column(3), column(4))
+    energy, energy_index = np.unique(column(8), return_inverse=True)
+    energy = np.array([list(map(float, e.split(b"-"))) for e in energy])
+    energy = energy.reshape(-1, 2)
+
+    n_tokens = int(np.sum(tokens_per_line))
+    line_of_token = np.repeat(np.arange(n_lines), tokens_per_line)
+    is_flag = np.arange(n_tokens) - line_offsets[line_of_token] >= 13
+    flag_line = line_of_token[is_flag]
+    bits, quality = _classify_flag_tokens(
+        token_column(
+            buffer, token_starts[:n_tokens][is_flag], token_ends[:n_tokens][is_flag]
+        )
+    )
+    flags = np.zeros(n_lines, dtype=np.int32)
+    np.bitwise_or.at(flags, flag_line, bits)
+    # Like get_quality, use the first quality flag in each line.
+    has_quality = quality >= 0
+    quality_lines, first = np.unique(flag_line[has_quality], return_index=True)
+    line_quality = np.full(n_lines, -1, dtype=np.int64)
+    line_quality[quality_lines] = quality[has_quality][first]
+
+    return (
+        {
+            "flare_id": column(0).astype(np.int64),
+            "peak_time": times["peak_time"],
+            "start_time": times["start_time"],
+            "end_time": times["end_time"],
+            "total_counts": column(7).astype(np.float64),
+            "energy_range": energy[energy_index.reshape(-1)],
+            "x": column(9).astype(np.float64),
+            "y": column(10).astype(np.float64),
+            "radial": column(11).astype(np.float64),
+            "quality": line_quality,
+            "flags": flags,
+        },
+        done,
+        table_bytes,
+    )
+
+
+def parse_flare_list(
+    chunk_size: int, offset: Optional[int] = None
+) -> Tuple[Dict[str, np.ndarray], int]:
+    """
+    Parse the flare list into columns, see load_txt_file_streaming.
+
+    If an offset is given, parsing starts at this byte position in the file
+    instead of after the header. It must be the start of a line in the table.
+    Returns the columns and the byte offset of the end of the table.
+    This is where parsing has to start once more flares have been added.
+    Reading stops in the chunk that contains the end of the table.
+    """
+    empty, *_ = parse_chunk(np.zeros(0, dtype=np.uint8))
+    buffers = {
+        key: ColumnBuffer(val.dtype, val.shape[1:]) for key, val in empty.items()
+    }
+
+    with profiling.stage("download"):
+        f = flare_list_file("rb")
+    with f:
+        if offset is None:
+            for _ in range(7):
+                f.readline()
+        else:
+            f.seek(offset)
+        end = f.tell()
+
+        for chunk in read_line_chunks(f, chunk_size):
+            columns, done, table_bytes = parse_chunk(chunk)
+            end += table_bytes
+            for key, val in columns.items():
+                buffers[key].extend(val)
+            if done:
+                break
+
+    values = {key: buffer.values for key, buffer in buffers.items()}
+    # Remove duplicates, keep the first occurrence of each flare like load_txt_file.
+    _, first = np.unique(values["flare_id"], return_index=True)
+    if len(first) < len(values["flare_id"]):
+        first.sort()
+        values = {key: val[first] for key, val in values.items()}
+    return values, end
+
+
+def load_txt_file_streaming(
+    chunk_size: int = 1 << 20,
+    packed_flags: bool = False,
+    cache: Optional[ParseCache] = None,
+) -> sc.DataArray:
+    """
+    Like load_txt_file but parses chunks of chunk_size bytes at a time.
+
+    The parsed columns are collected in numpy buffers which keeps the peak
+    memory usage close to the size of the final arrays.
+    If packed_flags is True, the flags are stored in a single attr
+    (see the bit layout next to FLAGS) instead of one boolean attr per flag.
+    If a cache is given, the columns are loaded from it if the file has been
+    parsed before.
+    """
+    values, _ = load_flare_columns(chunk_size, cache)
+    return make_flare_array(values, packed_flags)
+
+
+def load_flare_columns(
+    chunk_size: int = 1 << 20, cache: Optional[ParseCache] = None
+) -> Tuple[Dict[str, np.ndarray], int]:
+    """parse_flare_list of the whole file, from the cache if possible."""
+    if cache is None:
+        return parse_flare_list(chunk_size)
+    key = cache_key("rhessi", PARSER_VERSION, FLARE_LIST_HASH)
+    if (values := cache.get(key)) is None:
+        values, end = parse_flare_list(chunk_size)
+        cache.put(key, {**values, "table_end": np.array(end)})
+        return values, end
+    end = int(values.pop("table_end"))
+    return values, end
+
+
+def make_flare_array(values: Dict[str, np.ndarray], packed_flags: bool) -> sc.DataArray:
+    """Build a data array from the columns returned by parse_flare_list."""
+    values = dict(values)
+    if packed_flags:
+        return make_data_array(values)
+
+    flags = values.pop("flags")
+    quality = values.pop("quality")
+    values["eclipsed"] = (flags & np.int32(flag_mask(ECLIPSED_FLAGS))) != 0
+    values["non_solar"] = (flags & np.int32(flag_mask(["NS"]))) != 0
+    values["quality"] = quality
+    for i, name in enumerate(FLAGS):
+        values[name] = (flags & np.int32(1 << i)) != 0
+    return make_data_array(values)
+
+
+# Columns that prefilter removes.
+PREFILTER_DROPPED = (
+    "total_counts",
+    "radial",
+    "flare_id",
+    "eclipsed",
+    "quality",
+    "flags",
+    *FLAGS,
+)
+
+
 def prefilter(da):
-    da = da.copy()
-    del da.coords["total_counts"]
-    del da.coords["radial"]
-    del da.attrs["flare_id"]
-    da = da[~da.attrs.pop("eclipsed")]
-    # no quality flag
-    da = da[da.attrs["quality"] >= sc.index(0)]
-    # only high quality
-    da = da[da.attrs["quality"] < sc.index(3)]
-    del da.attrs["quality"]
+    """
+    Remove low quality and unusable flares and columns that are not needed.
+
+    All conditions are combined into a single mask and the unneeded columns are
+    dropped before selecting so that every remaining column is copied only once.
+    """
+    attrs = da.attrs
     # PS - Possible Solar Flare; in front detectors, but no position
-    da = da[~da.attrs.pop("PS")]
+    if "flags" in attrs:
+        keep = ~any_flag(attrs["flags"], *ECLIPSED_FLAGS, "PS")
+    else:
+        keep = ~(attrs["eclipsed"] | attrs["PS"])
+    # no quality flag and only high quality
+    keep &= attrs["quality"] >= sc.index(0)
+    keep &= attrs["quality"] < sc.index(3)
+
+    out = sc.DataArray(
+        da.data,
+        coords={
+            key: val for key, val in da.coords.items() if key not in PREFILTER_DROPPED
+        },
+        attrs={key: val for key, val in attrs.items() if key not in PREFILTER_DROPPED},
+    )
+    if "flags" in attrs:
+        out.attrs["non_solar"] = any_flag(attrs["flags"], "NS")
+    return out[keep]
+
+
+def make_compact(da: sc.DataArray) -> sc.DataArray:
+    """
+    Convert the output of remove_events to use less memory and disk space.
+
+    float64 coords and attrs along 'flare' are stored as float32,
+    which is exact for the positions and energies in the flare list,
+    and the data is a broadcast scalar.
+    Use expand_compact to get back to the default layout.
+    """
+    out = sc.DataArray(
+        compact_ones(da.sizes, da.unit), coords=dict(da.coords), attrs=dict(da.attrs)
+    )
+    for mapping in (out.coords, out.attrs):
+        for key, var in mapping.items():
+            if var.dtype == sc.DType.float64 and "flare" in var.dims:
+                mapping[key] = var.astype("float32")
+    return out
+
+
+def expand_compact(da: sc.DataArray) -> sc.DataArray:
+    """Convert the output of make_compact back to the default layout."""
+    out = sc.DataArray(
+        da.data.astype("float64"), coords=dict(da.coords), attrs=dict(da.attrs)
+    )
+    for mapping in (out.coords, out.attrs):
+        for key, var in mapping.items():
+            if var.dtype == sc.DType.float32:
+                mapping[key] = var.astype("float64")
+    return out
 
-    for flag in FLAGS:
-        try:
-            del da.attrs[flag]
-        except KeyError:
-            pass
-    return da
 
+def to_compact(da: sc.DataArray) -> sc.DataArray:
+    """make_compact with a check that no information is lost."""
+    compact = make_compact(da)
+    check_round_trip(da, expand_compact(compact))
+    return compact
 
-def remove_events(da, rng):
+
+def detector_efficiency() -> sc.DataArray:
     """
     Define fictitious efficiencies for the different collimators of the detector.
     Uses a 3x3 detector grid with arbitrarily chosen apertures.
-    Events are removed randomly based on the efficiencies such that the data
-    can be normalised using `events / efficiency`.
     """
-    print("removing events based on detector efficiency")
     collimator_x = sc.array(
         dims=["x"], values=[-1000, -300, 300, 1000], unit="asec", dtype="float64"
     )
     collimator_y = sc.array(
         dims=["y"], values=[-600, -200, 200, 600], unit="asec", dtype="float64"
     )
-    efficiency = sc.DataArray(
+    return sc.DataArray(
         sc.array(
             dims=["x", "y"],
             values=np.array(
@@ -190,6 +533,66 @@ def remove_events(da, rng):
         coords={"x": collimator_x, "y": collimator_y},
     )
 
+
+def remove_events(da, rng, efficiency=None, legacy=False):
+    """
+    Remove events randomly based on detector efficiencies such that the data
+    can be normalised using `events / efficiency`.
+
+    `efficiency` is a 2d array with bin-edges for x and y, by default
+    `detector_efficiency()`. Events outside the grid are always kept.
+    In each cell, exactly int(n * efficiency) of the n events are kept.
+
+    The result is deterministic for a given input and state of `rng`.
+    But the events are drawn differently from the original loop-based
+    implementation. Use `legacy=True` to reproduce the exact selection
+    of the original (and the published rhessi_flares.h5); this is much slower.
+    """
+    print("removing events based on detector efficiency")
+    if efficiency is None:
+        efficiency = detector_efficiency()
+    if legacy:
+        out = _remove_events_legacy(da, rng, efficiency)
+    else:
+        out = da[sc.array(dims=da.dims, values=_select_events(da, rng, efficiency))]
+        peak_time = out.coords["peak_time"].values
+        if not np.all(peak_time[1:] >= peak_time[:-1]):
+            out = sc.sort(out, "peak_time")
+    out.attrs["detector_efficiency"] = sc.scalar(efficiency)
+    return out
+
+
+def _select_events(da, rng, efficiency) -> np.ndarray:
+    """Return a mask that is True for the events to keep."""
+    edges_x = efficiency.coords["x"].to(unit=da.coords["x"].unit).values
+    edges_y = efficiency.coords["y"].to(unit=da.coords["y"].unit).values
+    n_x, n_y = len(edges_x) - 1, len(edges_y) - 1
+    # Bins are [edges[i], edges[i+1]) like label-based slicing.
+    ix = np.searchsorted(edges_x, da.coords["x"].values, side="right") - 1
+    iy = np.searchsorted(edges_y, da.coords["y"].values, side="right") - 1
+    in_grid = np.flatnonzero((ix >= 0) & (ix < n_x) & (iy >= 0) & (iy < n_y))
+    cell = ix[in_grid] * n_y + iy[in_grid]
+
+    # Keep the events with the lowest random priorities in each cell.
+    n_per_cell = np.bincount(cell, minlength=n_x * n_y)
+    n_keep = (n_per_cell * efficiency.transpose(["x", "y"]).values.ravel()).astype(
+        np.int64
+    )
+    # Sort by cell and by priority within each cell in one go.
+    order = np.argsort(cell + rng.random(len(cell)))
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order)) - np.repeat(
+        np.cumsum(n_per_cell) - n_per_cell, n_per_cell
+    )
+    keep = np.ones(len(ix), dtype=bool)
+    keep[in_grid[rank >= n_keep[cell]]] = False
+    return keep
+
+
+def _remove_events_legacy(da, rng, efficiency):
+    collimator_x = efficiency.coords["x"]
+    collimator_y = efficiency.coords["y"]
+
     da = sc.sort(da, "x")
     filtered = []
     for i in range(len(collimator_x) - 1):
@@ -209,17 +612,209 @@ def remove_events(da, rng):
     filtered.append(da["x", -1e8 * collimator_x.unit : collimator_x[0]])
     filtered.append(da["x", collimator_x[-1] : 11e8 * collimator_x.unit])
 
-    out = sc.sort(sc.concat(filtered, "flare"), "peak_time")
-    out.attrs["detector_efficiency"] = sc.scalar(efficiency)
-    return out
+    return sc.sort(sc.concat(filtered, "flare"), "peak_time")
 
 
-def main():
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--packed-flags",
+        action="store_true",
+        help="Store all flags in a single integer attr while processing",
+    )
+    parser.add_argument(
+        "--legacy-thinning",
+        action="store_true",
+        help="Remove events exactly like the original implementation of remove_events",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="Do not use the parse cache"
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Write smaller dtypes, see make_compact",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Append new flares to an existing output file instead of rewriting it",
+    )
+    parser.add_argument(
+        "--column-store",
+        action="store_true",
+        help="Also export the output to data/rhessi_flares/, see column_store.py",
+    )
+    parser.add_argument(
+        "--pyramid",
+        action="store_true",
+        help="Also write pre-binned histograms to data/rhessi_pyramid.h5",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=DEFAULT_MAX_SIZE,
+        help="Maximum size of the parse cache in bytes",
+    )
+    profiling.add_arguments(parser)
+    return parser.parse_args()
+
+
+def source_metadata(flare_id: np.ndarray, peak_time: np.ndarray, end: int) -> dict:
+    """
+    Metadata that update_output uses to find the new flares.
+
+    end is the offset of the end of the table as returned by parse_flare_list.
+    """
+    return {
+        "source_hash": FLARE_LIST_HASH,
+        "source_offset": end,
+        "last_flare_id": int(flare_id.max(initial=-1)),
+        "last_peak_time": int(
+            peak_time.view(np.int64).max(initial=np.iinfo(np.int64).min)
+        ),
+    }
+
+
+def update_output(fname: Path, args) -> bool:
+    """
+    Append flares that are not yet in fname.
+
+    The flare list only grows at the end.
+    So only the rows after the stored end of the table with a flare_id that
+    is greater than the stored ones are parsed.
+    Nothing before the stored end is read, the time of an update only
+    depends on the number of new flares.
+    Events are removed from the new flares on their own with a random
+    generator that is seeded from the last stored flare_id.
+    So the result depends on the history of updates and is not the same as
+    for a full rewrite.
+
+    Returns False if the output cannot be updated because it has no metadata,
+    was written in a different mode, or new flares are older than the stored ones.
+    """
+    metadata = read_metadata(fname)
+    if "source_offset" not in metadata:
+        return False
+    if bool(metadata.get("compact", False)) != args.compact:
+        return False
+    if metadata["source_hash"] == FLARE_LIST_HASH:
+        return True
+
+    last_flare_id = int(metadata["last_flare_id"])
+    with profiling.stage("parse") as s:
+        values, end = parse_flare_list(1 << 20, offset=int(metadata["source_offset"]))
+        new = values["flare_id"] > last_flare_id
+        values = {key: val[new] for key, val in values.items()}
+        s.set(rows_out=int(np.count_nonzero(new)))
+    peak_time = values["peak_time"].view(np.int64)
+    if np.any(peak_time < metadata["last_peak_time"]):
+        return False
+
+    print(f"appending {len(peak_time)} flares to {fname}")
+    new_metadata = source_metadata(values["flare_id"], values["peak_time"], end)
+    new_metadata["last_flare_id"] = max(new_metadata["last_flare_id"], last_flare_id)
+    new_metadata["last_peak_time"] = max(
+        new_metadata["last_peak_time"], int(metadata["last_peak_time"])
+    )
+    with profiling.stage("prefilter", rows_in=len(peak_time)) as s:
+        da = prefilter(make_flare_array(values, args.packed_flags))
+        s.set(rows_out=da.sizes["flare"])
+    rng = np.random.default_rng([9274, last_flare_id])
+    with profiling.stage("remove_events", rows_in=da.sizes["flare"]) as s:
+        da = remove_events(da, rng, legacy=args.legacy_thinning)
+        s.set(rows_out=da.sizes["flare"])
+    if args.compact:
+        with profiling.stage("compact"):
+            da = to_compact(da)
+    with profiling.stage("append", rows_in=da.sizes["flare"]) as s:
+        size = fname.stat().st_size
+        append(da, fname, "flare", **new_metadata)
+        s.set(rows_out=da.sizes["flare"], bytes_written=fname.stat().st_size - size)
+    with profiling.stage("time_index"):
+        update_time_index(fname, "peak_time")
+    return True
+
+
+# Coords needed by HistogramPyramid.from_events.
+PYRAMID_COLUMNS = ("x", "y", "peak_time", "start_time", "end_time")
+
+
+def write_output(fname: Path, args) -> sc.DataArray:
+    """Write all flares to fname and return them."""
     rng = np.random.default_rng(9274)
-    da = load_txt_file()
-    da = prefilter(da)
-    da = remove_events(da, rng)
-    da.to_hdf5(DATA_DIR / "rhessi_flares.h5")
+    cache = None if args.no_cache else ParseCache(max_size=args.cache_size)
+    with profiling.stage("parse") as s:
+        values, end = load_flare_columns(cache=cache)
+        da = make_flare_array(values, args.packed_flags)
+        s.set(rows_out=da.sizes["flare"])
+    metadata = source_metadata(
+        da.attrs["flare_id"].values, da.coords["peak_time"].values, end
+    )
+    with profiling.stage("prefilter", rows_in=da.sizes["flare"]) as s:
+        da = prefilter(da)
+        s.set(rows_out=da.sizes["flare"])
+    with profiling.stage("remove_events", rows_in=da.sizes["flare"]) as s:
+        da = remove_events(da, rng, legacy=args.legacy_thinning)
+        s.set(rows_out=da.sizes["flare"])
+    if args.compact:
+        with profiling.stage("compact"):
+            da = to_compact(da)
+    with profiling.stage("to_hdf5", rows_in=da.sizes["flare"]) as s:
+        save_appendable(
+            da,
+            fname,
+            "flare",
+            compression="gzip" if args.compact else None,
+            compact=args.compact,
+            **metadata,
+        )
+        s.set(rows_out=da.sizes["flare"], written=fname)
+    with profiling.stage("time_index"):
+        update_time_index(fname, "peak_time")
+    return da
+
+
+def main():
+    args = parse_args()
+    if args.profile or args.profile_json:
+        profiling.enable()
+    try:
+        run(args)
+    finally:
+        profiling.finish(
+            "prepare_exercise_data_rhessi", args.profile, args.profile_json
+        )
+
+
+def run(args):
+    out = DATA_DIR / "rhessi_flares.h5"
+    # After an incremental update, only the new flares are in memory and
+    # the other outputs are made from the whole file.
+    da = None
+    if args.incremental and out.exists():
+        with profiling.stage("update"):
+            updated = update_output(out, args)
+        if not updated:
+            print(f"cannot append to {out}, rewriting it")
+            with profiling.stage("write"):
+                da = write_output(out, args)
+    else:
+        with profiling.stage("write"):
+            da = write_output(out, args)
+
+    if args.column_store:
+        print("exporting column store")
+        with profiling.stage("column_store") as s:
+            export_columns(load_range(out) if da is None else da, COLUMN_STORE_DIR)
+            s.set(written=COLUMN_STORE_DIR)
+    if args.pyramid:
+        print("building histogram pyramid")
+        pyramid_file = DATA_DIR / "rhessi_pyramid.h5"
+        with profiling.stage("pyramid") as s:
+            events = load_range(out, columns=PYRAMID_COLUMNS) if da is None else da
+            HistogramPyramid.from_events(events).save(pyramid_file)
+            s.set(written=pyramid_file)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,340 @@
+"""
+Per-stage timing and memory usage of the prepare scripts.
+
+Stages are marked with `profiling.stage`:
+    with profiling.stage("parse") as s:
+        da = load_txt_file()
+        s.set(rows_out=da.sizes["flare"])
+For each stage, the wall time, CPU time (including finished child processes),
+RSS at the start of the stage, peak RSS during the stage, rows in and out,
+and bytes written are recorded.
+RSS is that of this process, worker processes are not included.
+Stages can be nested, nested stages are named like 'update/parse'.
+
+The peak RSS is measured by resetting the high-water mark of the kernel at
+the start of every stage, see reset_peak_rss.
+This needs Linux, elsewhere the RSS values are None.
+
+Profiling is off unless `enable` is called.
+Then `stage` returns a shared object that does nothing, so the overhead is a
+function call per stage.
+
+Run this file to compare two JSON profiles:
+    python profiling.py compare old.json new.json
+"""
+
+from __future__ import annotations
+import argparse
+from dataclasses import asdict, dataclass
+import json
+import os
+from pathlib import Path
+import sys
+import time
+from typing import Any, Dict, List, Optional, Union
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, CPU time of children is not recorded.
+    resource = None
+
+PROFILE_VERSION = 2
+
+_records: Optional[List[StageRecord]] = None
+_stack: List[_Stage] = []
+
+
+@dataclass
+class StageRecord:
+    name: str
+    wall_time: float = 0.0
+    cpu_time: float = 0.0
+    # In bytes, None if unknown.
+    start_rss: Optional[int] = None
+    peak_rss: Optional[int] = None
+    rows_in: Optional[int] = None
+    rows_out: Optional[int] = None
+    bytes_written: Optional[int] = None
+
+
+def _cpu_time() -> float:
+    if resource is None:
+        return time.process_time()
+    return sum(
+        usage.ru_utime + usage.ru_stime
+        for usage in (
+            resource.getrusage(resource.RUSAGE_SELF),
+            resource.getrusage(resource.RUSAGE_CHILDREN),
+        )
+    )
+
+
+def _memory_status() -> Dict[str, int]:
+    """Current ('VmRSS') and peak ('VmHWM') RSS in bytes, empty if unknown."""
+    try:
+        with open("/proc/self/status") as f:
+            lines = f.readlines()
+    except OSError:
+        return {}
+    return {
+        key: int(value.split()[0]) * 1024
+        for key, value in (line.split(":", 1) for line in lines)
+        if key in ("VmRSS", "VmHWM")
+    }
+
+
+def current_rss() -> Optional[int]:
+    return _memory_status().get("VmRSS")
+
+
+def peak_rss() -> Optional[int]:
+    """Peak RSS since the start of the process or the last reset_peak_rss."""
+    return _memory_status().get("VmHWM")
+
+
+def reset_peak_rss() -> bool:
+    """
+    Set the peak RSS to the current RSS.
+
+    Unlike ru_maxrss, which is the peak over the lifetime of the process,
+    this allows measuring the peak of a single stage.
+    Returns False if this is not supported (Linux >= 4.0 only).
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def path_size(path: Union[str, Path]) -> int:
+    """Size of a file or the total size of the files in a directory."""
+    path = Path(path)
+    if path.is_dir():
+        return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+    return path.stat().st_size
+
+
+class _Stage:
+    def __init__(self, name: str, rows_in: Optional[int]):
+        self.name = name
+        self.record = StageRecord(
+            name="/".join([*(s.name for s in _stack), name]), rows_in=rows_in
+        )
+        # Peak RSS of parts of the stage before nested stages reset the peak.
+        self._peak: Optional[int] = None
+
+    def set(
+        self,
+        rows_in: Optional[int] = None,
+        rows_out: Optional[int] = None,
+        bytes_written: Optional[int] = None,
+        written: Optional[Union[str, Path]] = None,
+    ) -> None:
+        """
+        Record the number of rows and the size of the output.
+
+        `written` is the name of a file or directory that was written.
+        Its size is added to the bytes written by this stage.
+        """
+        if rows_in is not None:
+            self.record.rows_in = rows_in
+        if rows_out is not None:
+            self.record.rows_out = rows_out
+        if written is not None:
+            bytes_written = (bytes_written or 0) + path_size(written)
+        if bytes_written is not None:
+            self.record.bytes_written = (self.record.bytes_written or 0) + bytes_written
+
+    def _fold_peak(self, peak: Optional[int]) -> None:
+        if peak is not None:
+            self._peak = peak if self._peak is None else max(self._peak, peak)
+
+    def __enter__(self) -> _Stage:
+        if _stack:
+            _stack[-1]._fold_peak(peak_rss())
+        if reset_peak_rss():
+            self.record.start_rss = current_rss()
+        _stack.append(self)
+        # Keep the order in which stages start.
+        _records.append(self.record)
+        self._wall = time.perf_counter()
+        self._cpu = _cpu_time()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.record.wall_time = time.perf_counter() - self._wall
+        self.record.cpu_time = _cpu_time() - self._cpu
+        _stack.pop()
+        if self.record.start_rss is not None:
+            self._fold_peak(peak_rss())
+            self.record.peak_rss = self._peak
+            if _stack:
+                _stack[-1]._fold_peak(self._peak)
+
+
+class _NullStage:
+    def set(
+        self, rows_in=None, rows_out=None, bytes_written=None, written=None
+    ) -> None:
+        pass
+
+    def __enter__(self) -> _NullStage:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+def enable() -> None:
+    """Start recording stages, discards previous records."""
+    global _records
+    _records = []
+    _stack.clear()
+
+
+def enabled() -> bool:
+    return _records is not None
+
+
+def stage(name: str, rows_in: Optional[int] = None) -> Union[_Stage, _NullStage]:
+    if _records is None:
+        return _NULL_STAGE
+    return _Stage(name, rows_in)
+
+
+def records() -> List[StageRecord]:
+    return list(_records or [])
+
+
+def _format_bytes(n: Optional[int]) -> str:
+    if n is None:
+        return "-"
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if n < 1024 or unit == "GiB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+
+
+def _format_count(n: Optional[int]) -> str:
+    return "-" if n is None else str(n)
+
+
+def format_report(stages: List[StageRecord]) -> str:
+    rows = [
+        (
+            "stage",
+            "wall [s]",
+            "cpu [s]",
+            "start rss",
+            "peak rss",
+            "rows in",
+            "rows out",
+            "written",
+        )
+    ]
+    for r in stages:
+        rows.append(
+            (
+                r.name,
+                f"{r.wall_time:.3f}",
+                f"{r.cpu_time:.3f}",
+                _format_bytes(r.start_rss),
+                _format_bytes(r.peak_rss),
+                _format_count(r.rows_in),
+                _format_count(r.rows_out),
+                _format_bytes(r.bytes_written),
+            )
+        )
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return "\n".join(
+        "  ".join(
+            cell.ljust(width) if i == 0 else cell.rjust(width)
+            for i, (cell, width) in enumerate(zip(row, widths))
+        )
+        for row in rows
+    )
+
+
+def to_json(script: str) -> Dict[str, Any]:
+    return {
+        "version": PROFILE_VERSION,
+        "script": script,
+        "argv": sys.argv[1:],
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "pid": os.getpid(),
+        "stages": [asdict(r) for r in records()],
+    }
+
+
+def finish(script: str, print_report: bool, json_path: Optional[Path]) -> None:
+    """Print the report and / or write it as JSON if profiling is enabled."""
+    if not enabled():
+        return
+    if print_report:
+        print(format_report(records()))
+    if json_path is not None:
+        Path(json_path).write_text(json.dumps(to_json(script), indent=1))
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add --profile and --profile-json to the command line of a prepare script."""
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print the time and memory used by each stage",
+    )
+    parser.add_argument(
+        "--profile-json",
+        type=Path,
+        default=None,
+        help="Write the time and memory used by each stage to this JSON file",
+    )
+
+
+def _load(path: Path) -> Dict[str, StageRecord]:
+    profile = json.loads(Path(path).read_text())
+    if profile["version"] != PROFILE_VERSION:
+        raise ValueError(f"Unsupported profile version {profile['version']}")
+    return {r["name"]: StageRecord(**r) for r in profile["stages"]}
+
+
+def compare(old: Path, new: Path) -> str:
+    """Compare the wall time and peak RSS of the stages in two JSON profiles."""
+    old, new = _load(old), _load(new)
+    lines = []
+    for name in [*old, *(name for name in new if name not in old)]:
+        if name not in old or name not in new:
+            lines.append(f"{name}: only in {'new' if name in new else 'old'}")
+            continue
+        a, b = old[name], new[name]
+        ratio = b.wall_time / a.wall_time if a.wall_time > 0 else float("inf")
+        lines.append(
+            f"{name}: wall {a.wall_time:.3f}s -> {b.wall_time:.3f}s ({ratio:.2f}x),"
+            f" peak rss {_format_bytes(a.peak_rss)} -> {_format_bytes(b.peak_rss)}"
+        )
+    return "\n".join(lines)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare profiles")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    compare_parser = subparsers.add_parser("compare", help="Compare two JSON profiles")
+    compare_parser.add_argument("old", type=Path)
+    compare_parser.add_argument("new", type=Path)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command == "compare":
+        print(compare(args.old, args.new))
+
+
+if __name__ == "__main__":
+    main()
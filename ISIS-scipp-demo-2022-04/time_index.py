@@ -0,0 +1,170 @@
+"""
+Coarse time index for the flare HDF5 files and a lazy reader which uses it.
+
+The index is stored in the group 'time_index' next to the data array written
+by scipp and is ignored by `sc.io.open_hdf5`.
+It holds the first row of every day that has events which allows `load_range`
+to only read the rows of a time range instead of the whole file.
+The data must be sorted by the indexed coord.
+"""
+
+from __future__ import annotations
+from pathlib import Path
+from typing import Iterable, Optional, Tuple, Union
+
+import h5py
+import numpy as np
+import scipp as sc
+
+from common import read_scipp_group
+
+INDEX_GROUP = "time_index"
+# Width of the index bins in seconds.
+BIN_WIDTH = 24 * 60 * 60
+
+
+def _find_variable(f: h5py.File, name: str) -> Tuple[str, h5py.Group]:
+    """Return the section and group of the coord, attr, or mask with the given name."""
+    for section in ("coords", "attrs", "masks"):
+        for group in f[section].values():
+            if group.attrs["name"] == name:
+                return section, group
+    raise KeyError(f"No variable named {name} in {f.filename}")
+
+
+def _read_unit(dataset: h5py.Dataset) -> Optional[sc.Unit]:
+    if "unit" not in dataset.attrs:
+        return None
+    unit = dataset.attrs["unit"]
+    if isinstance(unit, str):
+        return sc.Unit(unit)
+    unit_dict = {"__version__": unit["__version__"], "multiplier": unit["multiplier"]}
+    if "powers" in unit.dtype.names:
+        unit_dict["powers"] = {
+            name: unit["powers"][name] for name in unit["powers"].dtype.names
+        }
+    return sc.Unit.from_dict(unit_dict)
+
+
+def _read_rows(group: h5py.Group, dim: str, rows: slice) -> sc.Variable:
+    """Read a variable, only the given rows if it depends on dim."""
+    values = group.get("values")
+    if not isinstance(values, h5py.Dataset) or dim not in list(values.attrs["dims"]):
+        return read_scipp_group(group)
+    dims = list(values.attrs["dims"])
+    dtype = values.attrs["dtype"]
+    unit = _read_unit(values)
+    if dtype == "string":
+        return sc.array(dims=dims, values=list(values.asstr()[rows]), unit=unit)
+    if dtype == "datetime64":
+        return sc.array(
+            dims=dims, values=values[rows].view(f"datetime64[{unit}]"), unit=unit
+        )
+    var = sc.array(dims=dims, values=values[rows], unit=unit)
+    if "variances" in group:
+        var.variances = group["variances"][rows]
+    return var
+
+
+def update_time_index(fname: Union[str, Path], coord: str) -> None:
+    """
+    Write or extend the time index of a file.
+
+    If the file already has an index, only the rows after the start of the
+    last indexed day are read such that updates after `incremental.append`
+    scale with the number of new rows.
+    """
+    with h5py.File(fname, "r+") as f:
+        _, group = _find_variable(f, coord)
+        values = group["values"]
+        if values.attrs["dtype"] != "datetime64" or _read_unit(values) != sc.Unit("s"):
+            raise sc.DTypeError("The time index requires datetime64 in seconds")
+        days = np.zeros(0, dtype=np.int64)
+        offsets = np.zeros(1, dtype=np.int64)
+        if INDEX_GROUP in f and f[INDEX_GROUP].attrs["coord"] == coord:
+            days = f[INDEX_GROUP]["day"][:-1]
+            offsets = f[INDEX_GROUP]["offset"][:-1]
+        start = int(offsets[-1])
+        time = values[start:]
+        if np.any(time[1:] < time[:-1]):
+            raise ValueError(f"{fname} is not sorted by {coord}")
+
+        new_days, first = np.unique(time // BIN_WIDTH, return_index=True)
+        days = np.concatenate([days, new_days])
+        offsets = np.concatenate(
+            [offsets[:-1], start + first, [values.shape[0]]]
+        ).astype(np.int64)
+
+        if INDEX_GROUP in f:
+            del f[INDEX_GROUP]
+        index = f.create_group(INDEX_GROUP)
+        index.attrs["coord"] = coord
+        index.attrs["dim"] = list(values.attrs["dims"])[0]
+        index.attrs["bin_width"] = BIN_WIDTH
+        index["day"] = days
+        index["offset"] = offsets
+
+
+def _seconds(t: sc.Variable) -> int:
+    # Convert with numpy, scipp does not convert datetimes in days to seconds.
+    return int(np.datetime64(t.value, "s").astype(np.int64))
+
+
+def _first_row_at(
+    time: h5py.Dataset,
+    days: np.ndarray,
+    offsets: np.ndarray,
+    bin_width: int,
+    t: int,
+) -> int:
+    """Return the first row with time >= t, reading only the rows of one bin."""
+    day = t // bin_width
+    begin = int(offsets[np.searchsorted(days, day)])
+    end = int(offsets[np.searchsorted(days, day, "right")])
+    return begin + int(np.searchsorted(time[begin:end], t))
+
+
+def load_range(
+    fname: Union[str, Path],
+    start: Optional[sc.Variable] = None,
+    stop: Optional[sc.Variable] = None,
+    columns: Optional[Iterable[str]] = None,
+) -> sc.DataArray:
+    """
+    Load the events with start <= time < stop from a file with a time index.
+
+    `start` and `stop` are datetime scalars, e.g., `sc.datetime('2010-01-01')`.
+    Either can be None to not limit the range on that side.
+    `columns` is a list of names of coords, attrs, and masks to load,
+    by default all of them.
+    Only the requested columns and the rows in the range are read from the file.
+    """
+    with h5py.File(fname, "r") as f:
+        index = f[INDEX_GROUP]
+        coord = index.attrs["coord"]
+        dim = index.attrs["dim"]
+        days = index["day"][()]
+        offsets = index["offset"][()]
+        bin_width = int(index.attrs["bin_width"])
+        _, time_group = _find_variable(f, coord)
+        time = time_group["values"]
+        begin, end = 0, int(offsets[-1])
+        if start is not None:
+            begin = _first_row_at(time, days, offsets, bin_width, _seconds(start))
+        if stop is not None:
+            end = _first_row_at(time, days, offsets, bin_width, _seconds(stop))
+        rows = slice(begin, max(begin, end))
+
+        if columns is None:
+            columns = [
+                group.attrs["name"]
+                for section in ("coords", "attrs", "masks")
+                for group in f[section].values()
+            ]
+        contents = {"coords": {}, "attrs": {}, "masks": {}}
+        for name in columns:
+            section, group = _find_variable(f, name)
+            contents[section][name] = _read_rows(group, dim, rows)
+        return sc.DataArray(
+            _read_rows(f["data"], dim, rows), name=f.attrs["name"], **contents
+        )